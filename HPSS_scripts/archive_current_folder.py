@@ -1,13 +1,207 @@
 #!/usr/bin/env python
 
+import argparse
+import hashlib
+import json
 import os
+import os.path as path
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 
+# Stores state of the last chunked archivation in the archived folder
+manifest_name = ".hpss_manifest.json"
 
-def main():
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Archives current folder to HPSS")
+    parser.add_argument("-p", "--parallel", type=int,
+                        help="Number of simultaneous htar streams. If greater than 1 (or in incremental mode), the folder is archived in chunks. "
+                             "Default: 1, or the number of chunks of the last chunked archivation in incremental mode")
+    parser.add_argument("-s", "--split", choices=["subtree", "size"],
+                        help="How to split the folder into chunks: one chunk per top-level J_* folder or a fixed number of size-balanced chunks. "
+                             "Default: subtree, or the splitting of the last chunked archivation in incremental mode")
+    parser.add_argument("-i", "--incremental", action="store_true", help="Only re-archive chunks that changed since the last chunked archivation")
+    parser.add_argument("--htar", default="htar", help="htar command (can be replaced with a local stand-in)")
+
+    args = parser.parse_args()
+    resolve_chunking(args)
+    return args
+
+
+def resolve_chunking(args: argparse.Namespace):
+    """ In incremental mode, takes unspecified splitting and number of chunks from the manifest, so that the folder is split
+    into the same chunks as in the last archivation and unchanged chunks are not archived again. """
+    manifest = load_manifest() if args.incremental else {"chunks": {}}
+    chunk_names = list(manifest["chunks"])
+    if "split" in manifest:
+        recorded_split, recorded_chunks = manifest["split"], manifest["num_chunks"]
+    elif len(chunk_names) > 0 and all(name.startswith("chunk_") for name in chunk_names):
+        # manifests made before splitting was recorded: size split chunks are numbered
+        recorded_split, recorded_chunks = "size", max(int(name[len("chunk_"):]) for name in chunk_names) + 1
+    elif len(chunk_names) > 0:
+        recorded_split, recorded_chunks = "subtree", None
+    else:
+        recorded_split, recorded_chunks = None, None
+
+    if args.split is None:
+        args.split = recorded_split or "subtree"
+    if args.parallel is None:
+        if args.incremental and args.split == "size" and recorded_split == "size":
+            args.parallel = recorded_chunks
+        elif args.incremental:
+            args.parallel = 2  # subtree chunks do not depend on the number of streams
+        else:
+            args.parallel = 1
+    if args.incremental and args.split == "size" and recorded_split == "size" and args.parallel != recorded_chunks:
+        print("Warning: number of chunks differs from the last archivation ({0}), all chunks will be archived again".format(recorded_chunks))
+
+
+def get_hpss_path() -> str:
     cwd = os.getcwd()
-    hpss_path = cwd.split("spectrumsdt/", 1)[1]  # take path after spectrumsdt/
-    subprocess.call("htar -cPf {0}/data.tar .".format(hpss_path), shell=True)
+    return cwd.split("spectrumsdt/", 1)[1]  # take path after spectrumsdt/
+
+
+def list_units() -> List[str]:
+    """ Returns top-level entries of the current folder, which are the units of splitting into chunks. """
+    return sorted(entry for entry in os.listdir(".") if entry != manifest_name)
+
+
+def list_files(unit: str) -> List[str]:
+    """ Returns paths to all files in a top-level entry. """
+    if not path.isdir(unit) or path.islink(unit):
+        return [unit]
+    files = []
+    for folder, _, file_names in os.walk(unit):
+        files += [path.join(folder, file_name) for file_name in file_names]
+    return files
+
+
+def is_safe_member_path(member_path: str) -> bool:
+    """ Returns True if an archive member would be extracted inside the current folder (no absolute paths or .. components). """
+    return not path.isabs(member_path) and ".." not in member_path.replace("\\", "/").split("/")
+
+
+def compute_checksum(file_path: str) -> str:
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def describe_file(file_path: str, known: List = None) -> List:
+    """ Returns [size, mtime, checksum] of a file. Checksum is taken from *known* description if size and mtime did not change. """
+    file_stat = os.lstat(file_path)
+    if known is not None and known[0] == file_stat.st_size and known[1] == file_stat.st_mtime_ns:
+        return known
+    checksum = compute_checksum(file_path) if path.isfile(file_path) and not path.islink(file_path) else ""
+    return [file_stat.st_size, file_stat.st_mtime_ns, checksum]
+
+
+def split_by_subtree(units: List[str]) -> Dict[str, List[str]]:
+    """ Makes a chunk for each J_* folder and puts all other entries into chunk named rest. """
+    chunks = {}
+    for unit in units:
+        chunk_name = unit if unit.startswith("J_") and path.isdir(unit) else "rest"
+        chunks.setdefault(chunk_name, []).append(unit)
+    return chunks
+
+
+def split_by_size(units: List[str], unit_sizes: Dict[str, int], num_chunks: int, old_chunks: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """ Distributes units over *num_chunks* chunks with balanced total sizes. Units keep their chunks from *old_chunks*
+    (so unchanged chunks do not need re-archivation), new units are added to the currently smallest chunks. """
+    chunks = {f"chunk_{ind}": [] for ind in range(num_chunks)}
+    for chunk_name, chunk_units in old_chunks.items():
+        if chunk_name in chunks:
+            chunks[chunk_name] = [unit for unit in chunk_units if unit in unit_sizes]
+    assigned = set(unit for chunk_units in chunks.values() for unit in chunk_units)
+    chunk_sizes = {chunk_name: sum(unit_sizes[unit] for unit in chunk_units) for chunk_name, chunk_units in chunks.items()}
+    for unit in sorted(units, key=lambda unit: unit_sizes[unit], reverse=True):
+        if unit not in assigned:
+            smallest_chunk = min(chunk_sizes, key=chunk_sizes.get)
+            chunks[smallest_chunk].append(unit)
+            chunk_sizes[smallest_chunk] += unit_sizes[unit]
+    return {chunk_name: sorted(chunk_units) for chunk_name, chunk_units in chunks.items() if len(chunk_units) > 0}
+
+
+def load_manifest() -> Dict:
+    if not path.exists(manifest_name):
+        return {"chunks": {}, "files": {}}
+    with open(manifest_name) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest: Dict):
+    with open(manifest_name + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_name + ".tmp", manifest_name)
+
+
+def archive_chunk(htar: str, hpss_path: str, chunk_name: str, units: List[str]) -> int:
+    command = "{0} -cPf {1}/data_{2}.tar {3}".format(htar, hpss_path, chunk_name, " ".join(units))
+    return subprocess.call(command, shell=True)
+
+
+def archive_chunks(args: argparse.Namespace, hpss_path: str):
+    """ Splits the current folder into chunks and archives them in parallel. In incremental mode, only archives chunks with changes. """
+    old_manifest = load_manifest() if args.incremental else {"chunks": {}, "files": {}}
+    units = list_units()
+    unit_files = {unit: list_files(unit) for unit in units}
+    all_files = [file_path for unit in units for file_path in unit_files[unit]]
+    with ThreadPoolExecutor(args.parallel) as executor:
+        descriptions = executor.map(lambda file_path: describe_file(file_path, old_manifest["files"].get(file_path)), all_files)
+        files = dict(zip(all_files, descriptions))
+
+    if args.split == "subtree":
+        chunks = split_by_subtree(units)
+    else:
+        unit_sizes = {unit: sum(files[file_path][0] for file_path in unit_files[unit]) for unit in units}
+        chunks = split_by_size(units, unit_sizes, args.parallel, old_manifest["chunks"])
+
+    def chunk_changed(chunk_name: str) -> bool:
+        if old_manifest["chunks"].get(chunk_name) != chunks[chunk_name]:
+            return True
+        chunk_files = [file_path for unit in chunks[chunk_name] for file_path in unit_files[unit]]
+        old_chunk_files = [file_path for file_path in old_manifest["files"] if file_path.split("/", 1)[0] in chunks[chunk_name]]
+        return (len(chunk_files) != len(old_chunk_files)
+                or any(old_manifest["files"].get(file_path, [None])[2:] != files[file_path][2:] for file_path in chunk_files))
+
+    changed_chunks = [chunk_name for chunk_name in chunks if chunk_changed(chunk_name)]
+    chunk_sizes = {chunk_name: sum(files[file_path][0] for unit in chunks[chunk_name] for file_path in unit_files[unit]) for chunk_name in chunks}
+    changed_chunks.sort(key=chunk_sizes.get, reverse=True)  # largest first for better balance
+    print("Archiving {0} out of {1} chunks".format(len(changed_chunks), len(chunks)))
+    with ThreadPoolExecutor(args.parallel) as executor:
+        return_codes = dict(zip(changed_chunks, executor.map(lambda chunk_name: archive_chunk(args.htar, hpss_path, chunk_name, chunks[chunk_name]),
+                                                             changed_chunks)))
+
+    # Failed chunks keep their old descriptions, so they are retried next time
+    new_manifest = {"split": args.split, "num_chunks": args.parallel if args.split == "size" else len(chunks), "chunks": {}, "files": {}}
+    for chunk_name, chunk_units in chunks.items():
+        if return_codes.get(chunk_name, 0) == 0:
+            new_manifest["chunks"][chunk_name] = chunk_units
+            for unit in chunk_units:
+                for file_path in unit_files[unit]:
+                    new_manifest["files"][file_path] = files[file_path]
+        else:
+            print("Failed to archive chunk {0}".format(chunk_name))
+            if chunk_name in old_manifest["chunks"]:
+                new_manifest["chunks"][chunk_name] = old_manifest["chunks"][chunk_name]
+            for file_path, description in old_manifest["files"].items():
+                if file_path.split("/", 1)[0] in chunk_units:
+                    new_manifest["files"][file_path] = description
+    save_manifest(new_manifest)
+
+
+def main():
+    args = parse_command_line_args()
+    hpss_path = get_hpss_path()
+    # incremental archivation needs the chunks and the manifest even with a single stream
+    if args.parallel == 1 and not args.incremental:
+        subprocess.call("{0} -cPf {1}/data.tar .".format(args.htar, hpss_path), shell=True)
+    else:
+        archive_chunks(args, hpss_path)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import os.path as path
+import struct
+import zlib
+from typing import Dict, List
+
+from archive_current_folder import is_safe_member_path
+
+bundle_name = "small_files.bundle"
+# Bundle layout: compressed members one after another, then JSON index, then footer (index length and magic)
+footer_format = "<Q8s"
+footer_magic = b"SMLBNDL1"
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Bundles small files of each subtree into a single compressed file with an index (for HPSS transfers)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pack_parser = subparsers.add_parser("pack", help="Bundles small files in each subtree of the current folder")
+    pack_parser.add_argument("-d", "--depth", type=int, default=1, help="Depth of subtrees that get their own bundle (1 - each top-level folder)")
+    pack_parser.add_argument("-s", "--max-size", type=float, default=1, help="Files smaller than this (in MB) are bundled")
+    pack_parser.add_argument("-k", "--keep", action="store_true",
+                             help="Keep bundled files in place (they have to be excluded from archivation separately). By default, they are removed "
+                                  "and the bundle keeps them; new or changed small files are merged into the existing bundle on the next packing")
+
+    unpack_parser = subparsers.add_parser("unpack", help="Extracts files from bundles")
+    unpack_parser.add_argument("bundles", nargs="*", help="Bundles to extract. By default, all bundles in the current folder")
+    unpack_parser.add_argument("-m", "--member", nargs="+", help="Extract only these members (paths relative to bundle folder)")
+
+    list_parser = subparsers.add_parser("list", help="Lists members of a bundle")
+    list_parser.add_argument("bundle", help="Path to bundle")
+
+    args = parser.parse_args()
+    return args
+
+
+def find_subtrees(depth: int) -> List[str]:
+    """ Returns all folders located *depth* levels below the current folder. """
+    subtrees = ["."]
+    for _ in range(depth):
+        subtrees = [path.normpath(path.join(folder, entry)) for folder in subtrees for entry in sorted(os.listdir(folder))
+                    if path.isdir(path.join(folder, entry)) and not path.islink(path.join(folder, entry))]
+    return subtrees
+
+
+def find_small_files(subtree: str, max_size: int) -> List[str]:
+    """ Returns paths (relative to *subtree*) of all regular files smaller than *max_size* bytes. """
+    small_files = []
+    for folder, _, file_names in os.walk(subtree):
+        for file_name in sorted(file_names):
+            file_path = path.join(folder, file_name)
+            if file_name != bundle_name and not path.islink(file_path) and path.getsize(file_path) < max_size:
+                small_files.append(path.relpath(file_path, subtree))
+    return small_files
+
+
+def pack(subtree: str, members: List[str], remove: bool, carried_index: Dict[str, List] = None):
+    """ Writes *members* of *subtree* into a bundle in *subtree*. Each member is compressed separately, so it can be extracted alone.
+    Members of the existing bundle listed in *carried_index* are copied from it as they are (e.g. members removed from the subtree earlier). """
+    index = {}
+    bundle_path = path.join(subtree, bundle_name)
+    with open(bundle_path + ".tmp", "wb") as bundle:
+        if carried_index:
+            with open(bundle_path, "rb") as old_bundle:
+                for member, (offset, compressed_size, size, mtime, mode) in carried_index.items():
+                    old_bundle.seek(offset)
+                    index[member] = [bundle.tell(), compressed_size, size, mtime, mode]
+                    bundle.write(old_bundle.read(compressed_size))
+        for member in members:
+            member_path = path.join(subtree, member)
+            with open(member_path, "rb") as member_file:
+                content = member_file.read()
+            compressed = zlib.compress(content)
+            member_stat = os.stat(member_path)
+            index[member] = [bundle.tell(), len(compressed), len(content), member_stat.st_mtime, member_stat.st_mode]
+            bundle.write(compressed)
+        index_bytes = json.dumps(index).encode()
+        bundle.write(index_bytes)
+        bundle.write(struct.pack(footer_format, len(index_bytes), footer_magic))
+    os.replace(bundle_path + ".tmp", bundle_path)
+    if remove:
+        for member in members:
+            os.remove(path.join(subtree, member))
+
+
+def is_bundled(subtree: str, member: str, index: Dict[str, List]) -> bool:
+    """ Returns True if the file *member* of *subtree* is in the bundle *index* with the same size and modification time. """
+    if member not in index:
+        return False
+    member_stat = os.stat(path.join(subtree, member))
+    _, _, size, mtime, _ = index[member]
+    return size == member_stat.st_size and abs(mtime - member_stat.st_mtime) < 1e-3
+
+
+def pack_subtree(subtree: str, max_size: float, keep: bool) -> int:
+    """ Bundles small files of *subtree*, or brings its existing bundle up to date. Returns the number of files written into the bundle.
+    Bundled files are removed unless *keep*, so the bundle keeps its members that are missing from the subtree. Small files that are new
+    or changed since bundling are merged into the bundle, unchanged ones (e.g. extracted or kept) are not rewritten. """
+    bundle_path = path.join(subtree, bundle_name)
+    small_files = find_small_files(subtree, max_size)
+    index = {}
+    if path.exists(bundle_path):
+        with open(bundle_path, "rb") as bundle:
+            index = read_index(bundle)
+    if all(is_bundled(subtree, member, index) for member in small_files):
+        if not keep:
+            for member in small_files:
+                os.remove(path.join(subtree, member))
+        return 0
+    carried_index = {member: entry for member, entry in index.items() if member not in small_files}
+    pack(subtree, small_files, not keep, carried_index)
+    print("{0}: bundled {1} files".format(subtree, len(small_files)))
+    return len(small_files)
+
+
+def read_index(bundle) -> Dict[str, List]:
+    """ Reads index of an open bundle file. """
+    footer_size = struct.calcsize(footer_format)
+    bundle.seek(-footer_size, os.SEEK_END)
+    index_size, magic = struct.unpack(footer_format, bundle.read(footer_size))
+    if magic != footer_magic:
+        raise Exception("{0} is not a bundle".format(bundle.name))
+    bundle.seek(-footer_size - index_size, os.SEEK_END)
+    return json.loads(bundle.read(index_size))
+
+
+def unpack(bundle_path: str, members: List[str] = None):
+    """ Extracts given *members* (all if None) of a bundle next to it. Only the requested members are read and decompressed. """
+    bundle_folder = path.dirname(bundle_path)
+    with open(bundle_path, "rb") as bundle:
+        index = read_index(bundle)
+        members = members if members is not None else list(index)
+        unsafe = [member for member in members if not is_safe_member_path(member)]
+        if len(unsafe) > 0:
+            raise Exception("Bundle {0} has members outside of its folder: {1}".format(bundle_path, ", ".join(unsafe[:10])))
+        for member in members:
+            offset, compressed_size, _, mtime, mode = index[member]
+            bundle.seek(offset)
+            content = zlib.decompress(bundle.read(compressed_size))
+            member_path = path.join(bundle_folder, member)
+            os.makedirs(path.dirname(member_path) or ".", exist_ok=True)
+            with open(member_path, "wb") as member_file:
+                member_file.write(content)
+            os.chmod(member_path, mode & 0o7777)
+            os.utime(member_path, (mtime, mtime))
+
+
+def find_bundles() -> List[str]:
+    return sorted(path.join(folder, bundle_name) for folder, _, file_names in os.walk(".") if bundle_name in file_names)
+
+
+def main():
+    args = parse_command_line_args()
+    if args.command == "pack":
+        total_files = 0
+        for subtree in find_subtrees(args.depth):
+            total_files += pack_subtree(subtree, args.max_size * 1024 * 1024, args.keep)
+        print("Bundled {0} files".format(total_files))
+    elif args.command == "unpack":
+        bundles = args.bundles if len(args.bundles) > 0 else find_bundles()
+        for bundle_path in bundles:
+            unpack(bundle_path, args.member)
+    elif args.command == "list":
+        with open(args.bundle, "rb") as bundle:
+            index = read_index(bundle)
+        for member, (_, compressed_size, size, _, _) in index.items():
+            print("{0:>12} {1:>12} {2}".format(size, compressed_size, member))
+
+
+if __name__ == "__main__":
+    main()
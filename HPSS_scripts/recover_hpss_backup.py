@@ -1,13 +1,120 @@
 #!/usr/bin/env python
 
+import argparse
+import fnmatch
 import os
+import re
 import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from archive_current_folder import get_hpss_path, is_safe_member_path, load_manifest
+
+folder_regexes = {name: re.compile(r"(?:^|/){0}_(\d+)(?:/|$)".format(name)) for name in ["J", "K", "symmetry"]}
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Restores current folder from HPSS")
+    parser.add_argument("-g", "--glob", nargs="+", help="Only restore members matching any of these path globs")
+    parser.add_argument("--J", type=int, nargs="+", help="Only restore members of these values of J")
+    parser.add_argument("--K", type=int, nargs="+", help="Only restore members of these values of K")
+    parser.add_argument("--sym", type=int, nargs="+", help="Only restore members of these values of symmetry")
+    parser.add_argument("-c", "--chunks", nargs="+",
+                        help="Names of archive chunks to restore from. By default, taken from local manifest or HPSS folder listing")
+    parser.add_argument("-p", "--parallel", type=int, default=4, help="Number of chunks restored simultaneously")
+    parser.add_argument("--htar", default="htar", help="htar command (can be replaced with a local stand-in)")
+    parser.add_argument("--hsi", default="hsi", help="hsi command (can be replaced with a local stand-in)")
+
+    args = parser.parse_args()
+    return args
+
+
+def is_selective(args: argparse.Namespace) -> bool:
+    return any(value is not None for value in [args.glob, args.J, args.K, args.sym])
+
+
+def find_archives(args: argparse.Namespace, hpss_path: str) -> List[str]:
+    """ Returns names of archives of the current folder. Chunked archives are preferred over the single data.tar. """
+    if args.chunks is not None:
+        return ["data_{0}.tar".format(chunk_name) for chunk_name in args.chunks]
+    manifest_chunks = load_manifest()["chunks"]
+    if len(manifest_chunks) > 0:
+        return ["data_{0}.tar".format(chunk_name) for chunk_name in manifest_chunks]
+    listing = subprocess.run("{0} -q ls -1 {1}".format(args.hsi, hpss_path), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True).stdout
+    names = [os.path.basename(line.strip()) for line in listing.splitlines()]
+    chunk_names = sorted(name for name in names if name.startswith("data_") and name.endswith(".tar"))
+    return chunk_names if len(chunk_names) > 0 else ["data.tar"]
+
+
+def list_members(htar: str, archive_path: str) -> List[Tuple[str, int]]:
+    """ Returns (path, size) of all file members of an archive, as given by its index. """
+    listing = subprocess.check_output("{0} -tvf {1}".format(htar, archive_path), shell=True, universal_newlines=True)
+    members = []
+    for line in listing.splitlines():
+        if line.startswith("HTAR: "):
+            line = line[len("HTAR: "):]
+        tokens = line.split()
+        if len(tokens) < 6 or not tokens[0].startswith("-"):
+            continue  # not a regular file record
+        members.append((tokens[-1], int(tokens[2])))
+    return members
+
+
+def check_members(archive_path: str, members: List[Tuple[str, int]]):
+    """ Refuses to extract archives with members that would be written outside of the current folder """
+    unsafe = [member_path for member_path, _ in members if not is_safe_member_path(member_path)]
+    if len(unsafe) > 0:
+        raise Exception("Archive {0} has members outside of the current folder: {1}".format(archive_path, ", ".join(unsafe[:10])))
+
+
+def is_member_selected(member_path: str, args: argparse.Namespace) -> bool:
+    if args.glob is not None and not any(fnmatch.fnmatch(member_path, pattern) for pattern in args.glob):
+        return False
+    for name, allowed in [("J", args.J), ("K", args.K), ("symmetry", args.sym)]:
+        if allowed is not None:
+            match = folder_regexes[name].search(member_path)
+            if match is None or int(match.group(1)) not in allowed:
+                return False
+    return True
+
+
+def restore_archive(args: argparse.Namespace, archive_path: str) -> int:
+    """ Restores selected members of an archive (or all of them if no selection is made). Returns the number of restored bytes. """
+    members = list_members(args.htar, archive_path)
+    check_members(archive_path, members)
+    if not is_selective(args):
+        subprocess.check_call("{0} -xf {1}".format(args.htar, archive_path), shell=True)
+        return sum(size for _, size in members)
+
+    selected = [(member_path, size) for member_path, size in members if is_member_selected(member_path, args)]
+    if len(selected) == 0:
+        return 0
+    with tempfile.NamedTemporaryFile("w", suffix=".list") as member_list:
+        member_list.write("\n".join(member_path for member_path, _ in selected) + "\n")
+        member_list.flush()
+        subprocess.check_call("{0} -xf {1} -L {2}".format(args.htar, archive_path, member_list.name), shell=True)
+    return sum(size for _, size in selected)
 
 
 def main():
-    cwd = os.getcwd()
-    hpss_path = cwd.split("spectrumsdt/", 1)[1]  # take path after spectrumsdt/
-    subprocess.call("htar -xf {0}/data.tar .".format(hpss_path), shell=True)
+    args = parse_command_line_args()
+    hpss_path = get_hpss_path()
+    archives = find_archives(args, hpss_path)
+    if not is_selective(args) and archives == ["data.tar"]:
+        check_members("data.tar", list_members(args.htar, "{0}/data.tar".format(hpss_path)))
+        subprocess.call("{0} -xf {1}/data.tar .".format(args.htar, hpss_path), shell=True)
+        return
+
+    start = time.time()
+    with ThreadPoolExecutor(args.parallel) as executor:
+        restored_bytes = sum(executor.map(lambda archive: restore_archive(args, "{0}/{1}".format(hpss_path, archive)), archives))
+    elapsed = time.time() - start
+    print("Restored {0:.1f} MB from {1} archives in {2:.1f} s ({3:.1f} MB/s)".format(
+        restored_bytes / 1e6, len(archives), elapsed, restored_bytes / 1e6 / max(elapsed, 1e-9)))
 
 
-main()
+if __name__ == "__main__":
+    main()
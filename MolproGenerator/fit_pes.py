@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+from __future__ import annotations
+
+import argparse
+import time
+from typing import List, Tuple
+
+import numpy
+from scipy.interpolate import LinearNDInterpolator, NdBSpline, NearestNDInterpolator, make_interp_spline
+
+
+class PESModel:
+    """ Tensor-product spline interpolant of energies given on a grid of placeholder values (as collected by parallel_pes.py).
+    Evaluation is vectorized over query points; points outside the grid evaluate to NaN. """
+    degree = 3
+
+    def __init__(self, names: List[str], knots: List[numpy.ndarray], coefficients: numpy.ndarray, degrees: List[int]):
+        self.names = names
+        self.knots = knots
+        self.coefficients = coefficients
+        self.degrees = degrees
+        self.spline = NdBSpline(tuple(knots), coefficients, tuple(degrees), extrapolate=False)
+
+    def __call__(self, points: numpy.ndarray) -> numpy.ndarray:
+        """ Evaluates the model at *points* (N x number of placeholders) """
+        return self.spline(points)
+
+    def get_bounds(self) -> List[Tuple[float, float]]:
+        return [(knots[degree], knots[-degree - 1]) for knots, degree in zip(self.knots, self.degrees)]
+
+    @classmethod
+    def fit(cls, names: List[str], axes: List[numpy.ndarray], energies: numpy.ndarray) -> PESModel:
+        """ Builds an interpolating spline of *energies* (grid of len(axes[0]) x len(axes[1]) x ...). The spline is fitted along one axis
+        at a time, which gives the coefficients of the tensor-product spline. Axes with few points get lower degrees. """
+        coefficients = energies
+        knots = []
+        degrees = []
+        for axis_ind, axis in enumerate(axes):
+            degree = min(cls.degree, len(axis) - 1)
+            spline = make_interp_spline(axis, coefficients, k=degree, axis=axis_ind)
+            coefficients = numpy.moveaxis(spline.c, 0, axis_ind)
+            knots.append(spline.t)
+            degrees.append(degree)
+        return cls(names, knots, coefficients, degrees)
+
+    def save(self, model_path: str):
+        """ Saves the model in numpy binary format (knots and coefficients only) """
+        arrays = {"knots_{0}".format(ind): knots for ind, knots in enumerate(self.knots)}
+        numpy.savez(model_path, names=numpy.array(self.names), coefficients=self.coefficients, degrees=numpy.array(self.degrees), **arrays)
+
+    @classmethod
+    def load(cls, model_path: str) -> PESModel:
+        with numpy.load(model_path) as model_file:
+            names = list(model_file["names"])
+            knots = [model_file["knots_{0}".format(ind)] for ind in range(len(names))]
+            return cls(names, knots, model_file["coefficients"], list(model_file["degrees"]))
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fits collected PES points with a tensor-product spline and evaluates the fitted model")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fit_parser = subparsers.add_parser("fit", help="Fits a model to a table made by parallel_pes.py in collect mode")
+    fit_parser.add_argument("table_path", help="Path to collected table")
+    fit_parser.add_argument("-o", "--output", help="Path to fitted model. Default: <table_path>.npz")
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="Evaluates a model at points from a text file (one point per line)")
+    evaluate_parser.add_argument("model_path", help="Path to fitted model")
+    evaluate_parser.add_argument("points_path", help="Path to points (columns in the same order as in the collected table)")
+    evaluate_parser.add_argument("-o", "--output", default="energies.txt", help="Path to output file")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Measures evaluation speed of a model at random points within its grid")
+    benchmark_parser.add_argument("model_path", help="Path to fitted model")
+    benchmark_parser.add_argument("-n", "--num-points", type=int, default=1000000, help="Number of points")
+
+    args = parser.parse_args()
+    if args.command == "fit" and args.output is None:
+        args.output = args.table_path + ".npz"
+    return args
+
+
+def read_table(table_path: str) -> Tuple[List[str], numpy.ndarray]:
+    """ Reads collected table. Returns placeholder names and the table (points x (placeholders + energy)) """
+    with open(table_path) as table_file:
+        names = table_file.readline().split()[:-1]
+    return names, numpy.loadtxt(table_path, skiprows=1, ndmin=2)
+
+
+def arrange_grid(table: numpy.ndarray) -> Tuple[List[numpy.ndarray], numpy.ndarray]:
+    """ Arranges table rows on a grid of all unique values of each placeholder. Grid points absent from the table (e.g. failed calculations)
+    are filled by linear interpolation of the present ones (nearest value outside their convex hull). """
+    rounded = numpy.round(table[:, :-1], 8)
+    axes = []
+    indices = []
+    for column in rounded.T:
+        axis, axis_indices = numpy.unique(column, return_inverse=True)
+        axes.append(axis)
+        indices.append(axis_indices)
+    energies = numpy.full([len(axis) for axis in axes], numpy.nan)
+    energies[tuple(indices)] = table[:, -1]
+
+    missing = numpy.isnan(energies)
+    num_missing = numpy.count_nonzero(missing)
+    if num_missing > 0:
+        if num_missing > energies.size / 2:
+            raise Exception("Points do not form a grid ({0} out of {1} grid points are missing)".format(num_missing, energies.size))
+        print("Filling {0} missing grid points".format(num_missing))
+        grid_points = numpy.stack(numpy.meshgrid(*axes, indexing="ij"), axis=-1)
+        filled = LinearNDInterpolator(table[:, :-1], table[:, -1])(grid_points[missing])
+        outside = numpy.isnan(filled)
+        filled[outside] = NearestNDInterpolator(table[:, :-1], table[:, -1])(grid_points[missing][outside])
+        energies[missing] = filled
+    return axes, energies
+
+
+def compute_holdout_errors(names: List[str], axes: List[numpy.ndarray], energies: numpy.ndarray):
+    """ Estimates fit errors: for each axis, every other inner grid line is held out, the model is fitted to the rest and evaluated at the
+    held-out points. Since the fit uses twice coarser grid along that axis, this is an upper estimate of the errors of the full model. """
+    print("{0:<12}{1:>12}{2:>16}{3:>16}".format("held out", "points", "RMS error", "max error"))
+    for axis_ind, axis in enumerate(axes):
+        if len(axis) < 5:
+            continue
+        held_out = numpy.zeros(len(axis), dtype=bool)
+        held_out[1:-1:2] = True
+        train_axes = axes[:axis_ind] + [axis[~held_out]] + axes[axis_ind + 1:]
+        model = PESModel.fit(names, train_axes, numpy.compress(~held_out, energies, axis=axis_ind))
+        test_axes = axes[:axis_ind] + [axis[held_out]] + axes[axis_ind + 1:]
+        test_points = numpy.stack(numpy.meshgrid(*test_axes, indexing="ij"), axis=-1).reshape(-1, len(axes))
+        errors = model(test_points) - numpy.compress(held_out, energies, axis=axis_ind).ravel()
+        print("{0:<12}{1:>12}{2:>16.3e}{3:>16.3e}".format(names[axis_ind], len(errors), numpy.sqrt(numpy.mean(errors ** 2)),
+                                                          numpy.max(numpy.abs(errors))))
+
+
+def main():
+    args = parse_command_line_args()
+    if args.command == "fit":
+        names, table = read_table(args.table_path)
+        axes, energies = arrange_grid(table)
+        print("Grid: " + " x ".join("{0} {1}".format(len(axis), name) for name, axis in zip(names, axes)))
+        model = PESModel.fit(names, axes, energies)
+        model.save(args.output)
+        compute_holdout_errors(names, axes, energies)
+    elif args.command == "evaluate":
+        model = PESModel.load(args.model_path)
+        points = numpy.loadtxt(args.points_path, ndmin=2)
+        numpy.savetxt(args.output, model(points), fmt="%.16g")
+    elif args.command == "benchmark":
+        model = PESModel.load(args.model_path)
+        rng = numpy.random.default_rng(0)
+        points = numpy.column_stack([rng.uniform(low, high, args.num_points) for low, high in model.get_bounds()])
+        start = time.perf_counter()
+        model(points)
+        elapsed = time.perf_counter() - start
+        print("Evaluated {0} points in {1:.3f} s ({2:.2e} points/s)".format(args.num_points, elapsed, args.num_points / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,17 +3,29 @@
 from __future__ import annotations
 
 import numpy
+import ctypes
+import ctypes.util
+import glob
 import itertools
+import json
 import os
 import os.path as path
+import select
+import struct
 import subprocess
 import re
 import argparse
-from typing import List, Tuple, Dict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Set, Tuple, Dict
 
 
 class Placeholder:
     """ Represents substitutable place in a template. Stores a list of values that are to be substituted into that place """
+    # Number of values read at once from point lists
+    chunk_size = 65536
+
     def __init__(self, data: str, template_dir: str = None):
         params = Placeholder.parse_params(data)
         self.name = params["name"]
@@ -37,12 +49,30 @@ class Placeholder:
             if values_str[-1] == "\n":
                 values_str = values_str[:-1]
             self.data = list(map(float, values_str))
+        # or taken from a column of a point list (.npy matrix with one row per point), which is memory mapped and read lazily
+        elif "points" in params:
+            self.data_source = "points"
+            file_path = path.join(template_dir, params["points"])
+            points = numpy.load(file_path, mmap_mode="r")
+            if points.ndim != 2:
+                raise Exception("Point list {0} has to be a matrix (points x placeholders)".format(file_path))
+            self.data = points[:, int(params["column"])]
         else:
             raise Exception('Placeholder data is not provided')
 
     def __iter__(self):
+        if self.data_source == "points":
+            return self.iterate_chunks()
         return iter(self.data)
 
+    def __len__(self):
+        return len(self.data)
+
+    def iterate_chunks(self):
+        """ Yields values of a point list column, converting one chunk at a time """
+        for start in range(0, len(self.data), Placeholder.chunk_size):
+            yield from self.data[start:start + Placeholder.chunk_size].tolist()
+
     def __str__(self):
         return "Name: {0}; data {1}".format(self.name, self.data)
 
@@ -59,6 +89,94 @@ class Placeholder:
         return iteration_params
 
 
+class InotifyWatcher:
+    """ Reports folders where output files were written (Linux inotify, called via libc) """
+    # IN_CLOSE_WRITE | IN_MOVED_TO
+    event_mask = 0x00000008 | 0x00000080
+    event_header_format = "iIII"
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify is not available")
+        self.folders = {}  # type: Dict[int, str]
+
+    def watch(self, folder: str):
+        watch_descriptor = self.libc.inotify_add_watch(self.fd, folder.encode(), self.event_mask)
+        if watch_descriptor < 0:
+            raise OSError(ctypes.get_errno(), "Failed to watch {0}".format(folder))
+        self.folders[watch_descriptor] = folder
+
+    def unwatch(self, folder: str):
+        for watch_descriptor in [key for key, value in self.folders.items() if value == folder]:
+            self.libc.inotify_rm_watch(self.fd, watch_descriptor)
+            del self.folders[watch_descriptor]
+
+    def wait(self, timeout: float) -> List[str]:
+        """ Waits up to *timeout* seconds for events. Returns folders where output files were written """
+        if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+            return []
+        data = os.read(self.fd, 1024 * 1024)
+        header_size = struct.calcsize(self.event_header_format)
+        folders = []
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, _, _, name_size = struct.unpack_from(self.event_header_format, data, offset)
+            name = data[offset + header_size:offset + header_size + name_size].rstrip(b"\0").decode()
+            offset += header_size + name_size
+            if name == self.file_name and watch_descriptor in self.folders and self.folders[watch_descriptor] not in folders:
+                folders.append(self.folders[watch_descriptor])
+        return folders
+
+    def close(self):
+        """ Closes inotify descriptor (which also removes all watches) """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+            self.folders = {}
+
+
+class PollingWatcher:
+    """ Reports folders where output files were written, by periodically checking modification times of output files """
+    def __init__(self, file_name: str, poll_interval: float):
+        self.file_name = file_name
+        self.poll_interval = poll_interval
+        self.last_poll = time.time()
+        self.states = {}  # type: Dict[str, Tuple[int, int]]
+
+    def get_state(self, folder: str) -> Tuple[int, int]:
+        try:
+            file_stat = os.stat(folder + self.file_name)
+            return file_stat.st_mtime_ns, file_stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def watch(self, folder: str):
+        self.states[folder] = self.get_state(folder)
+
+    def unwatch(self, folder: str):
+        self.states.pop(folder, None)
+
+    def wait(self, timeout: float) -> List[str]:
+        """ Waits up to *timeout* seconds. Output files are only checked once per poll interval """
+        time.sleep(max(min(timeout, self.last_poll + self.poll_interval - time.time()), 0))
+        if time.time() < self.last_poll + self.poll_interval:
+            return []
+        self.last_poll = time.time()
+        folders = []
+        for folder, old_state in self.states.items():
+            new_state = self.get_state(folder)
+            if new_state != old_state:
+                self.states[folder] = new_state
+                folders.append(folder)
+        return folders
+
+    def close(self):
+        self.states = {}
+
+
 class ScriptManager:
     """ Generates and submits multiple molpro jobs described via job templates """
     # creates a file with this name
@@ -69,6 +187,18 @@ class ScriptManager:
     queue_file_path = "queue"
     # Controls how many jobs can be sent at once
     queue_limit = 5000
+    # Failure triage (collect mode): texts in the tails of molpro output and slurm log that identify the cause of failure
+    failure_markers = {"walltime": ["DUE TO TIME LIMIT"],
+                       "memory": ["insufficient memory", "Out Of Memory", "oom-kill"],
+                       "convergence": ["No convergence", "NO CONVERGENCE"]}
+    # Stores the number of resubmissions of each failed point between collections
+    failure_history_path = "failure_history.json"
+    # Points that failed too many times are listed here and are not resubmitted anymore
+    quarantine_path = "quarantine"
+    failure_report_path = "failure_report.txt"
+    max_attempts = 3
+    # Keeps lines printed by templates followed in parallel from mixing
+    print_lock = threading.Lock()
 
     def __init__(self, template_path: str):
         # Path to template file describing what jobs need to be generated
@@ -81,6 +211,20 @@ class ScriptManager:
         self.flat_structure = False
         # Defines if indexes should be used instead of names to create input paths
         self.index_naming = False
+        # Value sets and folders of the points that failed during the last collection
+        self.failed_points = []  # type: List[Tuple[List[float], str]]
+        # Maps each point to the point that is calculated for it (see equivalences)
+        self.representatives = {}  # type: Dict[List[float], List[float]]
+        # Groups of names of placeholders that can be permuted without changing the result (e.g. equivalent bonds of a symmetric molecule).
+        # Only one point of each set of equivalent points is calculated, the results are copied to the others.
+        self.equivalences = []  # type: List[List[str]]
+        # If set, only the points with these rounded value sets (see get_point_key) are generated, e.g. points selected by a cheap method
+        self.selected_points = None  # type: Set[Tuple[float]]
+        # Set to stop following results (see follow_results), e.g. on Ctrl+C
+        self.stop_following = threading.Event()
+        # Points that have an input are considered submitted. Submit mode only submits the points without inputs (so that it can be repeated
+        # to submit newly added or selected points), collect mode only collects the submitted points.
+        self.incremental = False
 
     @staticmethod
     def submit_input(input_path: str, submit_command: str):
@@ -89,19 +233,46 @@ class ScriptManager:
 
     @staticmethod
     def submit_inputs(input_folder_paths: List[str], submit_command: str):
+        ScriptManager.submit_batches({submit_command: input_folder_paths})
+
+    @staticmethod
+    def submit_batches(batches: Dict[str, List[str]]):
+        """ Submits batches of inputs (keyed by the submit command used for the batch) within the queue limit """
         already_running = int(subprocess.check_output("q | wc -l", shell=True)) - 1
-        for i in range(min(len(input_folder_paths), ScriptManager.queue_limit - already_running)):
-            input_folder_path = input_folder_paths[i]
-            input_file_path = input_folder_path + ScriptManager.input_name
-            ScriptManager.submit_input(input_file_path, submit_command)
-        ScriptManager.save_remaining_jobs(input_folder_paths, max(ScriptManager.queue_limit - already_running, 0))
+        available = max(ScriptManager.queue_limit - already_running, 0)
+        remaining = []
+        for submit_command, input_folder_paths in batches.items():
+            for input_folder_path in input_folder_paths:
+                if available > 0:
+                    ScriptManager.submit_input(input_folder_path + ScriptManager.input_name, submit_command)
+                    available -= 1
+                else:
+                    remaining.append((input_folder_path, submit_command))
+        ScriptManager.save_remaining_jobs(remaining)
 
     @staticmethod
-    def save_remaining_jobs(input_folder_paths: List[str], starting_from: int):
-        if starting_from < len(input_folder_paths):
+    def save_remaining_jobs(remaining: List[Tuple[str, str]]):
+        """ Saves folder paths and submit commands of the jobs that did not fit in the queue """
+        if len(remaining) > 0:
             with open(ScriptManager.queue_file_path, "w") as queue_file:
-                for i in range(starting_from, len(input_folder_paths)):
-                    queue_file.write(input_folder_paths[i] + "\n")
+                for input_folder_path, submit_command in remaining:
+                    queue_file.write(input_folder_path + "\t" + submit_command + "\n")
+
+    @staticmethod
+    def load_remaining_jobs(default_submit_command: str) -> Dict[str, List[str]]:
+        """ Reads queue file into batches. Lines without a submit command (older queue files) use the default one """
+        batches = {}
+        with open(ScriptManager.queue_file_path) as queue_file:
+            for line in queue_file.read().splitlines():
+                tokens = line.split("\t")
+                submit_command = tokens[1] if len(tokens) > 1 else default_submit_command
+                batches.setdefault(submit_command, []).append(tokens[0])
+        return batches
+
+    @staticmethod
+    def interleave(lists: List[List]) -> List:
+        """ Merges lists by taking an item of each list in turn, so that every list gets a fair share of any leading part of the result """
+        return [item for items in itertools.zip_longest(*lists) for item in items if item is not None]
 
     @staticmethod
     def generate_input(input_folder_path: str, content: str, value_set: List[float]):
@@ -148,7 +319,287 @@ class ScriptManager:
                 out_file.write("\n")
                 for item in key:
                     out_file.write("{0:<#{1}.{2}g}".format(item, field_width, key_digits))
-                out_file.write("{0:<#{1}.{2}g}".format(collector[key], field_width, energy_digits))
+                # several results of a point (e.g. of a cascade) are written in separate columns
+                for value in collector[key] if isinstance(collector[key], tuple) else [collector[key]]:
+                    out_file.write("{0:<#{1}.{2}g}".format(value, field_width, energy_digits))
+
+    @staticmethod
+    def read_result(output_folder: str, result_regexp: str) -> float:
+        """ Returns the result from output file in output_folder, or None if there is no single result (e.g. job is still running) """
+        try:
+            with open(output_folder + ScriptManager.output_name) as output_file:
+                match = re.findall(result_regexp, output_file.read(), re.S)
+        except FileNotFoundError:
+            return None
+        return float(match[0]) if len(match) == 1 else None
+
+    def follow_results(self, collector: Dict[List[float], float], result_regexp: str, key_names: List[str], out_file_path: str,
+                       flush_interval: float, poll_interval: float, idle_timeout: float):
+        """ Keeps collecting results of the points that failed during the last collection (usually because they are still running),
+        parsing only the output files that are written. Periodically rewrites the results file and prints progress.
+        Stops when all points are either finished, failed (by failure markers) or idle (output not written for idle_timeout seconds,
+        e.g. the job was killed without a failure marker), or when stop_following is set. Leaves failed, idle and pending points in failed_points.
+        Several templates can be followed at once, each in its own thread. """
+        try:
+            watcher = InotifyWatcher(ScriptManager.output_name)
+        except OSError:
+            watcher = PollingWatcher(ScriptManager.output_name, poll_interval)
+        try:
+            pending = {}
+            failed_points = []
+            num_done = 0
+            for value_set, folder in self.failed_points:
+                if ScriptManager.classify_failure(folder, result_regexp) in ScriptManager.failure_markers:
+                    failed_points.append((value_set, folder))  # already failed
+                    continue
+                try:
+                    watcher.watch(folder)
+                except OSError:
+                    # e.g. out of inotify watches
+                    watcher.close()
+                    watcher = PollingWatcher(ScriptManager.output_name, poll_interval)
+                    for watched_folder in list(pending) + [folder]:
+                        watcher.watch(watched_folder)
+                # the job may have finished since the collection, before its folder was watched
+                result = ScriptManager.read_result(folder, result_regexp)
+                if result is not None:
+                    collector[value_set] = result
+                    num_done += 1
+                    watcher.unwatch(folder)
+                    continue
+                pending[folder] = value_set
+            ScriptManager.print_locked("Following {0} points of {1} ({2})".format(len(pending), self.template_path,
+                                                                               "inotify" if isinstance(watcher, InotifyWatcher) else "polling"))
+
+            total = len(pending) + num_done
+            num_finished_before = num_done
+            num_failed = 0
+            start = time.time()
+            last_flush = start
+            # Time of the last write of output of each pending point (or start of following)
+            last_activity = dict.fromkeys(pending, start)
+            while len(pending) > 0 and not self.stop_following.is_set():
+                # waits at most a second at a time, so that stopping is not delayed until the next flush
+                for folder in watcher.wait(min(max(last_flush + flush_interval - time.time(), 0), 1)):
+                    if folder not in pending:
+                        continue
+                    last_activity[folder] = time.time()
+                    result = ScriptManager.read_result(folder, result_regexp)
+                    if result is not None:
+                        collector[pending[folder]] = result
+                        num_done += 1
+                    elif ScriptManager.classify_failure(folder, result_regexp) in ScriptManager.failure_markers:
+                        ScriptManager.print_locked("Point {0} failed".format(pending[folder]))
+                        num_failed += 1
+                        failed_points.append((pending[folder], folder))
+                    else:
+                        continue  # still running
+                    watcher.unwatch(folder)
+                    del pending[folder]
+
+                flush_due = time.time() >= last_flush + flush_interval
+                for folder in [folder for folder in pending if flush_due and time.time() - last_activity[folder] > idle_timeout]:
+                    ScriptManager.print_locked("Point {0} stopped writing output, no longer followed".format(pending[folder]))
+                    num_failed += 1
+                    failed_points.append((pending[folder], folder))
+                    watcher.unwatch(folder)
+                    del pending[folder]
+
+                if flush_due or len(pending) == 0:
+                    ScriptManager.fill_equivalent_results(collector, self.representatives)
+                    ScriptManager.print_results(collector, key_names, out_file_path)
+                    elapsed = time.time() - start
+                    rate = (num_done - num_finished_before) / elapsed * 60
+                    eta = "{0:.0f} min".format(len(pending) / rate) if rate > 0 else "unknown"
+                    ScriptManager.print_locked("{0} {1}: done {2}, failed {3}, pending {4} out of {5}; {6:.1f} points/min; ETA {7}".format(
+                        time.strftime("%H:%M:%S"), self.template_path, num_done, num_failed, len(pending), total, rate, eta))
+                    last_flush = time.time()
+            ScriptManager.fill_equivalent_results(collector, self.representatives)
+            ScriptManager.print_results(collector, key_names, out_file_path)
+            self.failed_points = failed_points + [(value_set, folder) for folder, value_set in pending.items()]
+        finally:
+            watcher.close()
+
+    @staticmethod
+    def print_locked(message: str):
+        with ScriptManager.print_lock:
+            print(message)
+
+    @staticmethod
+    def fill_equivalent_results(collector: Dict[List[float], float], representatives: Dict[List[float], List[float]]):
+        """ Copies results of calculated points to the points equivalent to them
+        :param representatives: maps each point to the point that is actually calculated for it """
+        for key, representative in representatives.items():
+            if key != representative and representative in collector:
+                collector[key] = collector[representative]
+
+    @staticmethod
+    def read_tail(file_path: str, size: int = 4096) -> str:
+        with open(file_path, "rb") as file:
+            file.seek(max(path.getsize(file_path) - size, 0))
+            return file.read().decode(errors="replace")
+
+    @staticmethod
+    def classify_failure(output_folder: str, result_regexp: str) -> str:
+        """ Determines the cause of failure of a point from its output and the tail of its latest slurm log
+        :return one of: walltime, memory, convergence, multiple_results, missing_output, no_result """
+        output_path = output_folder + ScriptManager.output_name
+        slurm_logs = glob.glob(output_folder + "slurm-*.out")
+        text = ScriptManager.read_tail(max(slurm_logs, key=path.getmtime)) if len(slurm_logs) > 0 else ""
+        if path.exists(output_path):
+            text += ScriptManager.read_tail(output_path)
+        for failure_class, markers in ScriptManager.failure_markers.items():
+            if any(marker in text for marker in markers):
+                return failure_class
+        if not path.exists(output_path):
+            return "missing_output"
+        with open(output_path) as output_file:
+            if len(re.findall(result_regexp, output_file.read(), re.S)) > 1:
+                return "multiple_results"
+        return "no_result"
+
+    @staticmethod
+    def increase_memory(input_path: str, factor: int = 2) -> bool:
+        """ Multiplies memory requested by the memory directive of a molpro input. Returns False if the input has no memory directive """
+        with open(input_path) as input_file:
+            content = input_file.read()
+        content, num_subs = re.subn(r"^(\s*memory\s*,\s*)(\d+)", lambda match: match.group(1) + str(int(match.group(2)) * factor), content,
+                                    flags=re.I | re.M)
+        with open(input_path, "w") as input_file:
+            input_file.write(content)
+        return num_subs > 0
+
+    @staticmethod
+    def load_quarantine() -> List[str]:
+        if not path.exists(ScriptManager.quarantine_path):
+            return []
+        with open(ScriptManager.quarantine_path) as quarantine_file:
+            return [line.split("\t")[0] for line in quarantine_file.read().splitlines()]
+
+    @staticmethod
+    def triage_failures(failed_points: List[Tuple[List[float], str]], result_regexp: str, write_files: bool = False) -> List[Dict]:
+        """ Classifies failed points (value sets and folders) of the last collection and decides what to do with each: resubmit (with adjusted settings),
+        report only (resubmission would not help), or quarantine (failed too many times).
+        :param write_files: if true, writes failure report and quarantine list (when failures are resubmitted). Otherwise only prints the summary """
+        history = {}
+        if path.exists(ScriptManager.failure_history_path):
+            with open(ScriptManager.failure_history_path) as history_file:
+                history = json.load(history_file)
+        quarantine = ScriptManager.load_quarantine()
+
+        failures = []
+        for value_set, folder in failed_points:
+            failure_class = ScriptManager.classify_failure(folder, result_regexp)
+            attempts = history.get(folder, 0)
+            if folder in quarantine or attempts >= ScriptManager.max_attempts:
+                action = "quarantine"
+            elif failure_class == "multiple_results":
+                action = "report"
+            else:
+                action = "resubmit"
+            failures.append({"value_set": value_set, "folder": folder, "class": failure_class, "attempts": attempts, "action": action})
+
+        class_counts = {}
+        for failure in failures:
+            class_counts[failure["class"]] = class_counts.get(failure["class"], 0) + 1
+        quarantined = [failure for failure in failures if failure["action"] == "quarantine"]
+        print("Failures by class: " + ", ".join("{0} {1}".format(failure_class, class_counts[failure_class]) for failure_class in sorted(class_counts)))
+        if not write_files:
+            print("{0} points are to be quarantined (report and quarantine list are updated with resubmission)".format(len(quarantined)))
+            return failures
+
+        with open(ScriptManager.failure_report_path, "w") as report_file:
+            for failure_class in sorted(class_counts):
+                report_file.write("{0}: {1}\n".format(failure_class, class_counts[failure_class]))
+            for failure in failures:
+                report_file.write("{0}\t{1}\t{2}\t{3}\n".format(failure["folder"], failure["class"], failure["attempts"], failure["action"]))
+
+        if len(quarantined) > 0:
+            with open(ScriptManager.quarantine_path, "w") as quarantine_file:
+                for failure in quarantined:
+                    quarantine_file.write("{0}\t{1}\n".format(failure["folder"], failure["class"]))
+        elif path.exists(ScriptManager.quarantine_path):
+            os.remove(ScriptManager.quarantine_path)
+        print("Quarantined {0} points (see {1})".format(len(quarantined), ScriptManager.quarantine_path))
+        return failures
+
+    @staticmethod
+    def resubmit_failures(failures: List[Dict], submit_commands: Dict[str, str], restart_template_path: str = None):
+        """ Resubmits failures marked for resubmission, in batches by failure class. Memory failures get doubled memory in the input,
+        convergence failures get their input regenerated from the restart template (if given), for example to read orbitals
+        of the failed run. Submit commands for each class are taken from *submit_commands* ("default" for the classes not listed). """
+        restart_content = None
+        if restart_template_path is not None:
+            with open(restart_template_path) as template_file:
+                restart_content, _ = ScriptManager(restart_template_path).preprocess_template(template_file.read())
+
+        history = {}
+        batches = {}
+        for failure in failures:
+            if failure["action"] != "resubmit":
+                continue
+            folder = failure["folder"]
+            if failure["class"] == "memory":
+                if not ScriptManager.increase_memory(folder + ScriptManager.input_name):
+                    print("No memory directive in input of point {0}".format(failure["value_set"]))
+            elif failure["class"] == "convergence" and restart_content is not None:
+                ScriptManager.generate_input(folder, restart_content, failure["value_set"])
+            submit_command = submit_commands.get(failure["class"], submit_commands["default"])
+            batches.setdefault(submit_command, []).append(folder)
+            history[folder] = failure["attempts"] + 1
+
+        # Points that are not failed anymore are forgotten
+        with open(ScriptManager.failure_history_path, "w") as history_file:
+            json.dump(history, history_file)
+        ScriptManager.submit_batches(batches)
+
+    def get_equivalent_indices(self, placeholder_names: List[str]) -> List[List[int]]:
+        """ Converts groups of equivalent placeholder names to groups of their indices """
+        for name in itertools.chain(*self.equivalences):
+            if name not in placeholder_names:
+                raise Exception("Unknown placeholder {0} in equivalences".format(name))
+        return [[placeholder_names.index(name) for name in group] for group in self.equivalences]
+
+    @staticmethod
+    def get_point_key(value_set: List[float]) -> Tuple[float]:
+        """ Returns a key that identifies a point regardless of floating point noise (e.g. the same point of two templates) """
+        return tuple(round(value, 8) for value in value_set)
+
+    @staticmethod
+    def select_points(collector: Dict[List[float], float], key_names: List[str], selection_rule: str, min_energy: float = None) -> Set[Tuple[float]]:
+        """ Returns keys (see get_point_key) of the points whose results satisfy selection rule. The rule is a python expression
+        of placeholder names, energy (result of the point) and min_energy (reference energy, lowest result of all points by default) """
+        if len(collector) == 0:
+            return set()
+        if min_energy is None:
+            min_energy = min(collector.values())
+        selected = set()
+        for key, energy in collector.items():
+            namespace = dict(zip(key_names, key), energy=energy, min_energy=min_energy)
+            if eval(selection_rule, {"numpy": numpy}, namespace):
+                selected.add(ScriptManager.get_point_key(key))
+        return selected
+
+    @staticmethod
+    def merge_cascade_results(cheap_collector: Dict[List[float], float], expensive_collector: Dict[List[float], float]) -> Dict[List[float], Tuple[float, float]]:
+        """ Pairs results of both methods of a cascade for each point with a cheap result. Expensive result is nan for unselected points """
+        expensive_results = {ScriptManager.get_point_key(key): value for key, value in expensive_collector.items()}
+        return {key: (value, expensive_results.get(ScriptManager.get_point_key(key), float("nan"))) for key, value in cheap_collector.items()}
+
+    @staticmethod
+    def get_symmetry_key(value_set: List[float], equivalent_indices: List[List[int]]) -> Tuple[float]:
+        """ Returns a key that is the same for all points equivalent under permutations within each group of equivalent indices """
+        key = list(ScriptManager.get_point_key(value_set))  # rounding hides floating point noise of numpy.arange
+        for group in equivalent_indices:
+            for ind, value in zip(group, sorted(key[ind] for ind in group)):
+                key[ind] = value
+        return tuple(key)
+
+    def generate_value_sets(self, placeholders: List[Placeholder]) -> Tuple[Iterator[Tuple[float]], int]:
+        """ Returns a lazy iterator over combinations of placeholder values and the number of combinations """
+        if self.additive_mode:
+            return zip(*placeholders), min(len(x) for x in placeholders)
+        return itertools.product(*[x.data for x in placeholders]), numpy.prod([len(x) for x in placeholders], dtype=int)
 
     def process_template(self, collector: Dict[List[float], float] = None, result_regexp: str = None,
                          submit_command: str = None) -> Tuple[List[str], List[Placeholder]]:
@@ -161,23 +612,49 @@ class ScriptManager:
         if len(placeholders) == 0:
             raise Exception('Failed to find placeholders in the specified template')
 
-        if self.additive_mode:
-            substituents = list(zip(*[x.data for x in placeholders]))  # type: List[List[float]]
-        else:
-            substituents = list(itertools.product(*[x.data for x in placeholders]))  # type: List[List[float]]
-        print("Generated {0} combinations".format(len(substituents)))
+        value_sets, num_combinations = self.generate_value_sets(placeholders)
+        print("Generated {0} combinations".format(num_combinations))
+        placeholder_names = [x.name for x in placeholders]
+        # Maps each point to the first point equivalent to it, which is the only one that needs calculation. Only kept if there are equivalences.
+        equivalent_indices = self.get_equivalent_indices(placeholder_names)
+        first_members = {}
+        representatives = {}  # type: Dict[List[float], List[float]]
+
         input_paths = []
+        failed_points = []
         total_failed = 0
-        placeholder_names = [x.name for x in placeholders]
-        for i in range(len(substituents)):
-            value_set = substituents[i]
+        num_unique = 0
+        num_selected = 0
+        for i, value_set in enumerate(value_sets):
+            if len(equivalent_indices) > 0:
+                representatives[value_set] = first_members.setdefault(ScriptManager.get_symmetry_key(value_set, equivalent_indices), value_set)
+                if representatives[value_set] != value_set:
+                    continue
+            num_unique += 1
+            if self.selected_points is not None and ScriptManager.get_point_key(value_set) not in self.selected_points:
+                continue
+            num_selected += 1
             next_folder_path = self.generate_input_folder_path(placeholder_names, value_set, i)
+            if self.incremental and path.exists(next_folder_path + ScriptManager.input_name) == (collector is None):
+                continue
             input_paths.append(next_folder_path)
-            ScriptManager.generate_input(next_folder_path, content, value_set)
+            # existing inputs are kept in collecting mode, since they may have been adjusted for resubmission
+            if collector is None or not path.exists(next_folder_path + ScriptManager.input_name):
+                ScriptManager.generate_input(next_folder_path, content, value_set)
             # in collecting mode
             if collector is not None:
-                total_failed += ScriptManager.collect_results(next_folder_path, value_set, collector, result_regexp, submit_command)
-        print("Total failed {0} out of {1}".format(total_failed, len(substituents)))
+                if ScriptManager.collect_results(next_folder_path, value_set, collector, result_regexp, submit_command) != 0:
+                    total_failed += 1
+                    failed_points.append((value_set, next_folder_path))
+        if len(equivalent_indices) > 0:
+            print("Reduced to {0} combinations by symmetry".format(num_unique))
+        if self.selected_points is not None:
+            print("Selected {0} combinations".format(num_selected))
+        if collector is not None:
+            ScriptManager.fill_equivalent_results(collector, representatives)
+        print("Total failed {0} out of {1}".format(total_failed, len(input_paths)))
+        self.failed_points = failed_points
+        self.representatives = representatives
         return input_paths, placeholders
 
     def generate_input_folder_path(self, value_names: List[str], value_set: List[float], set_index: int) -> str:
@@ -187,7 +664,7 @@ class ScriptManager:
          :param value_set: List of values for variable job parameters. Used to generate unique path for each set of parameters
          :param set_index: A number used to label calculation folder when index naming is used"""
         if self.index_naming:
-            return self.template_dir + "/" + str(set_index) + "/"
+            return path.join(self.template_dir, str(set_index)) + "/"
         answer = self.template_dir
         for i in range(len(value_names)):
             value_name = value_names[i]
@@ -215,6 +692,10 @@ class ScriptManager:
             # File specification implies additive mode
             if placeholders[-1].data_source == "file":
                 self.additive_mode = True
+            # So do point lists. Sampled points are also named by index, since their values may coincide after rounding to folder names.
+            if placeholders[-1].data_source == "points":
+                self.additive_mode = True
+                self.index_naming = True
 
             # inserts {x} for placeholder number x at the place where it has to be inserted
             content = content[:start] + "{" + str(len(placeholders) - 1) + "}" + content[end + len(close_pattern):]
@@ -224,24 +705,86 @@ class ScriptManager:
 
 def parse_command_line_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Submits range of points for PES calculations")
-    parser.add_argument("template_path", help="Path to template file used to generate molpro jobs")
+    parser.add_argument("template_paths", nargs="+",
+                        help="Paths to template files used to generate molpro jobs. Several templates are processed concurrently and their jobs "
+                             "are submitted from one backlog, in which templates take turns (results are collected into <template_path>.out)")
     parser.add_argument("-cp", "--collect-path",
-                        help="Path to output file where the job results are to be written. Also switches to collect mode")
+                        help="Path to output file where the job results are to be written (single template only). Also switches to collect mode")
     parser.add_argument("-c", "--collect", action="store_true", help="Switch to collect mode")
-    parser.add_argument("-rf", "--resubmit-failed", action="store_true", help="Automatically resubmits job is result is not found")
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="Keep collecting results of running jobs as they finish (collect mode). Failures are triaged after all jobs finish")
+    parser.add_argument("-fi", "--flush-interval", type=float, default=60, help="How often results are written in follow mode (seconds)")
+    parser.add_argument("-it", "--idle-timeout", type=float,
+                        help="Follow mode stops waiting for the points whose output was not written for this long (hours), e.g. jobs killed without "
+                             "a failure marker. Queued jobs write no output, so it should exceed the queue wait. Default: job time (-t)")
+    parser.add_argument("-pi", "--poll-interval", type=float, default=10,
+                        help="How often output files are checked in follow mode when inotify is not available (seconds)")
+    parser.add_argument("-rf", "--resubmit-failed", action="store_true",
+                        help="Automatically resubmits job is result is not found. Settings of resubmission depend on the cause of failure. "
+                             "Failure report and quarantine list are only written with this option")
+    parser.add_argument("-rt", "--restart-template", help="Template used to regenerate inputs of the points that failed to converge (with -rf)")
+    parser.add_argument("-ma", "--max-attempts", type=int, default=3, help="Points that failed after this many resubmissions are quarantined")
+    parser.add_argument("-t", "--time", type=float, default=24, help="Job time (hours). Doubled for resubmission of the jobs that ran out of time")
     parser.add_argument("-ri", "--regex-id", type=int, choices={0, 1}, default=0, help="Select regex used to find result")
     parser.add_argument("-q", "--qos", default="regular", help="Quality of Service")
+    parser.add_argument("-ca", "--cascade", metavar="EXPENSIVE_TEMPLATE",
+                        help="Cheap method prescreen: the template is calculated with CCSD(T)-F12a over the full grid, and this template with MRCI "
+                             "only at the points selected by cheap results (regex id is ignored). Repeated submission submits newly selected points. "
+                             "Collection writes results of each template into <template_path>.out and both results into <EXPENSIVE_TEMPLATE>.cascade.out "
+                             "(for comparison, columns cheap_energy and mrci_energy; fit the .out tables)")
+    parser.add_argument("-ew", "--energy-window", type=float, nargs=2, metavar=("LOW", "HIGH"),
+                        help="Cascade selection: cheap energy relative to the lowest cheap energy (or --reference-energy) is within [LOW, HIGH] "
+                             "(same units as results)")
+    parser.add_argument("-sr", "--selection-rule",
+                        help="Cascade selection: python expression of placeholder names, energy and min_energy (lowest cheap energy), "
+                             "e.g. \"energy - min_energy < 0.05 and r1 < 4\"")
+    parser.add_argument("-re", "--reference-energy", type=float,
+                        help="Cascade selection: reference energy used as min_energy. By default, the lowest cheap energy is used, "
+                             "and expensive points are only submitted after all cheap points are finished")
+    parser.add_argument("-eq", "--equivalent", nargs="+", default=[],
+                        help="Groups of equivalent placeholders, each is a comma-separated list of names (e.g. r1,r2). "
+                             "Points that differ by permutation of values within a group are calculated once")
 
     args = parser.parse_args()
+    if len(args.template_paths) > 1 and args.collect_path is not None:
+        parser.error("--collect-path can only be used with a single template")
+    template_dirs = [path.abspath(path.dirname(template_path)) for template_path in args.template_paths]
+    if len(set(template_dirs)) < len(template_dirs):
+        parser.error("Templates have to be in different folders, since jobs of a template are generated in its folder")
+    if len(args.template_paths) > 1 and args.restart_template is not None:
+        parser.error("--restart-template can only be used with a single template")
+    if args.cascade is not None:
+        if len(args.template_paths) > 1 or args.follow or args.restart_template is not None:
+            parser.error("--cascade can only be used with a single (cheap) template and without --follow and --restart-template")
+        if args.energy_window is None and args.selection_rule is None:
+            parser.error("--cascade requires --energy-window or --selection-rule")
+        if path.abspath(path.dirname(args.cascade)) in template_dirs:
+            parser.error("Cheap and expensive (--cascade) templates have to be in different folders, since jobs of a template are generated in its folder")
     resolve_defaults(args)
     return args
 
 
 def resolve_defaults(args: argparse.Namespace):
-    if args.resubmit_failed:
+    if args.resubmit_failed or args.follow or args.collect_path is not None:
         args.collect = True
-    if args.collect_path is None and args.collect:
-        args.collect_path = args.template_path + ".out"
+    args.collect_paths = None
+    if args.collect:
+        if args.collect_path is not None:
+            args.collect_paths = [args.collect_path]
+        elif args.cascade is not None:
+            args.collect_paths = [args.cascade + ".cascade.out"]
+        else:
+            args.collect_paths = [template_path + ".out" for template_path in args.template_paths]
+
+
+def get_selection_rule(args: argparse.Namespace) -> str:
+    """ Combines cascade selection options into a single rule """
+    rules = []
+    if args.energy_window is not None:
+        rules.append("{0!r} <= energy - min_energy <= {1!r}".format(*args.energy_window))
+    if args.selection_rule is not None:
+        rules.append("(" + args.selection_rule + ")")
+    return " and ".join(rules)
 
 
 def select_result_regex(regex_id: int) -> str:
@@ -253,30 +796,107 @@ def select_result_regex(regex_id: int) -> str:
         return r"!CCSD\(T\)-F12a total energy\s+(.*?)\n"
 
 
+def get_submit_command(time: float, qos: str) -> str:
+    return "sub_molpro {0} -t " + "{0:g}".format(time) + " --no-queue" + " -q " + qos
+
+
+def run_cascade(args: argparse.Namespace, submit_command: str):
+    """ Cheap method prescreen. Submission submits cheap points that were not submitted yet, collects cheap results and submits
+    expensive points that were selected and not submitted yet. Collection writes cheap and expensive results and a table of both. """
+    cheap_regex = select_result_regex(1)
+    expensive_regex = select_result_regex(0)
+    cheap_manager = ScriptManager(args.template_paths[0])
+    expensive_manager = ScriptManager(args.cascade)
+    for script_manager in [cheap_manager, expensive_manager]:
+        script_manager.equivalences = [group.split(",") for group in args.equivalent]
+        script_manager.incremental = True
+
+    cheap_paths = []
+    if args.collect_paths is None:
+        cheap_paths, _ = cheap_manager.process_template()
+    cheap_collector = {}
+    _, placeholders = cheap_manager.process_template(cheap_collector, cheap_regex)
+    placeholder_names = [x.name for x in placeholders]
+    with open(args.cascade) as template_file:
+        _, expensive_placeholders = ScriptManager(args.cascade).preprocess_template(template_file.read())
+    if [x.name for x in expensive_placeholders] != placeholder_names:
+        raise Exception("Placeholders of cascade templates have to be the same")
+
+    # The lowest cheap energy is only final when all cheap points are finished. Points selected against a partial minimum could end up
+    # outside of the final window, so expensive points are not submitted until then (unless the reference energy is given explicitly).
+    if args.collect_paths is None and args.reference_energy is None and len(cheap_manager.failed_points) > 0:
+        print("Expensive points are selected when all cheap points are finished ({0} are pending or failed), or with --reference-energy".format(
+            len(cheap_manager.failed_points)))
+        ScriptManager.submit_inputs(cheap_paths, submit_command)
+        return
+    expensive_manager.selected_points = ScriptManager.select_points(cheap_collector, placeholder_names, get_selection_rule(args), args.reference_energy)
+    print("Cascade selected {0} out of {1} points with cheap results".format(len(expensive_manager.selected_points), len(cheap_collector)))
+    if args.collect_paths is None:
+        expensive_paths, _ = expensive_manager.process_template()
+        ScriptManager.submit_inputs(cheap_paths + expensive_paths, submit_command)
+        return
+
+    expensive_collector = {}
+    expensive_manager.process_template(expensive_collector, expensive_regex)
+    ScriptManager.print_results(cheap_collector, placeholder_names + ["energy"], cheap_manager.template_path + ".out")
+    ScriptManager.print_results(expensive_collector, placeholder_names + ["energy"], expensive_manager.template_path + ".out")
+    ScriptManager.print_results(ScriptManager.merge_cascade_results(cheap_collector, expensive_collector), placeholder_names + ["cheap_energy", "mrci_energy"],
+                                args.collect_paths[0])
+    # outputs of either method are classified with the regex that matches results of both
+    failures = ScriptManager.triage_failures(cheap_manager.failed_points + expensive_manager.failed_points,
+                                             "(?:{0})|(?:{1})".format(cheap_regex, expensive_regex), args.resubmit_failed)
+    if args.resubmit_failed:
+        submit_commands = {"default": submit_command, "walltime": get_submit_command(2 * args.time, args.qos)}
+        ScriptManager.resubmit_failures(failures, submit_commands)
+
+
 def main():
     # set script parameters, see also ScriptManager for extra parameters
     args = parse_command_line_args()
     result_regex = select_result_regex(args.regex_id)
-    submit_command = "sub_molpro {0} -t 24 --no-queue" + " -q " + args.qos
+    submit_command = get_submit_command(args.time, args.qos)
     resubmit_failed = args.resubmit_failed
-    script_manager = ScriptManager(args.template_path)
-
-    if args.collect_path is None:  # submit mode
-        if path.exists(ScriptManager.queue_file_path):  # there are some jobs still awaiting submission
-            with open(ScriptManager.queue_file_path) as queue_file:
-                input_paths = queue_file.read().splitlines()
-            os.remove(ScriptManager.queue_file_path)  # remove the file to avoid reading it again
-        else:
-            input_paths, placeholders = script_manager.process_template()
-        ScriptManager.submit_inputs(input_paths, submit_command)
+    ScriptManager.max_attempts = args.max_attempts
+    script_managers = [ScriptManager(template_path) for template_path in args.template_paths]
+    for script_manager in script_managers:
+        script_manager.equivalences = [group.split(",") for group in args.equivalent]
+
+    if args.collect_paths is None and path.exists(ScriptManager.queue_file_path):  # there are some jobs still awaiting submission
+        batches = ScriptManager.load_remaining_jobs(submit_command)
+        os.remove(ScriptManager.queue_file_path)  # remove the file to avoid reading it again
+        ScriptManager.submit_batches(batches)
+    elif args.cascade is not None:
+        run_cascade(args, submit_command)
+    elif args.collect_paths is None:  # submit mode
+        with ThreadPoolExecutor(len(script_managers)) as executor:
+            generated = list(executor.map(lambda manager: manager.process_template(), script_managers))
+        # one backlog for all templates, so that jobs left over the queue limit are shared fairly between templates
+        ScriptManager.submit_inputs(ScriptManager.interleave([input_paths for input_paths, _ in generated]), submit_command)
     else:  # collect results mode
-        collector = {}
+        collectors = [{} for _ in script_managers]
+        with ThreadPoolExecutor(len(script_managers)) as executor:
+            generated = list(executor.map(lambda manager, collector: manager.process_template(collector, result_regex), script_managers, collectors))
+        placeholder_names = []
+        for collector, (input_paths, placeholders), collect_path in zip(collectors, generated, args.collect_paths):
+            placeholder_names.append([x.name for x in placeholders] + ["energy"])  # table headers are placeholder names, last column is named energy
+            ScriptManager.print_results(collector, placeholder_names[-1], collect_path)
+        if args.follow:
+            # all templates are followed at once, so that results of each template are written as they come
+            with ThreadPoolExecutor(len(script_managers)) as executor:
+                futures = [executor.submit(script_manager.follow_results, collector, result_regex, key_names, collect_path, args.flush_interval,
+                                           args.poll_interval, (args.idle_timeout or args.time) * 3600)
+                           for script_manager, collector, key_names, collect_path in zip(script_managers, collectors, placeholder_names, args.collect_paths)]
+                try:
+                    for future in futures:
+                        future.result()
+                except KeyboardInterrupt:
+                    for script_manager in script_managers:
+                        script_manager.stop_following.set()
+        failures = ScriptManager.triage_failures(ScriptManager.interleave([manager.failed_points for manager in script_managers]), result_regex,
+                                                  resubmit_failed)
         if resubmit_failed:
-            input_paths, placeholders = script_manager.process_template(collector, result_regex, submit_command)
-        else:
-            input_paths, placeholders = script_manager.process_template(collector, result_regex)
-        placeholder_names = [x.name for x in placeholders] + ["energy"]  # table headers are placeholder names, last column is named energy
-        ScriptManager.print_results(collector, placeholder_names, args.collect_path)
+            submit_commands = {"default": submit_command, "walltime": get_submit_command(2 * args.time, args.qos)}
+            ScriptManager.resubmit_failures(failures, submit_commands, args.restart_template)
 
 
 main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+import argparse
+import itertools
+import json
+import numpy as np
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from results_db import find_states_files
+
+# Functions available in expressions, in addition to np and columns of state properties files
+expression_functions = {'np': np, 'exp': np.exp, 'log': np.log, 'sqrt': np.sqrt, 'abs': np.abs, 'where': np.where}
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Aggregates state properties over all J, K and symmetries. Files are streamed in parallel chunk by chunk, '
+                                                 'partial results of each (J, K, sym) are cached, so only new or changed files are processed again. '
+                                                 'Expressions can use columns of state properties files (non-alphanumeric characters of names are '
+                                                 'replaced with _), J, K, sym, state (1-based index) and numpy functions')
+    parser.add_argument('root_path', help='Path to the folder with J_* folders (either calculation or results tree)')
+    parser.add_argument('-s', '--sum', nargs='+', default=[], help='Sums of expressions over states: NAME=EXPR (e.g. Q=(2*J+1)*exp(-Energy/kT))')
+    parser.add_argument('-c', '--count', nargs='+', default=[], help='Numbers of states satisfying conditions: NAME=COND (e.g. bound="Energy < 0")')
+    parser.add_argument('-hs', '--histogram', nargs='+', default=[],
+                        help='Histograms of expressions: NAME=EXPR|bins=N|range=[MIN,MAX] with optional |weight=EXPR')
+    parser.add_argument('-g', '--group-by', nargs='*', default=[], choices=['J', 'K', 'sym'], help='Print sums and counts for each group')
+    parser.add_argument('-o', '--output', default='aggregate.json', help='Path to output file with totals and group results')
+    parser.add_argument('--cache', default='aggregate_cache.json', help='Path to cache of partial results of each file')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='Number of files processed in parallel')
+    parser.add_argument('-cs', '--chunk-size', type=int, default=100000, help='Number of states read at once')
+
+    args = parser.parse_args()
+    return args
+
+
+class Reduction:
+    """ Additive reduction of state properties (sum, count or histogram). Partial results of chunks, files and groups are combined by addition. """
+    def __init__(self, kind: str, spec: str):
+        self.kind = kind
+        self.name, description = spec.split('=', 1)
+        params = description.split('|')
+        self.expression = params[0]
+        options = dict(param.split('=', 1) for param in params[1:])
+        if kind == 'histogram':
+            self.bins = int(options['bins'])
+            self.range = eval(options['range'])
+            self.weight = options.get('weight')
+
+    def compute(self, namespace: Dict) -> np.ndarray:
+        values = eval(self.expression, expression_functions, namespace)
+        if self.kind == 'sum':
+            return np.asarray(np.sum(values), dtype=float)
+        elif self.kind == 'count':
+            return np.asarray(np.count_nonzero(values), dtype=float)
+        elif self.kind == 'histogram':
+            weights = eval(self.weight, expression_functions, namespace) if self.weight is not None else None
+            return np.histogram(values, self.bins, self.range, weights=weights)[0].astype(float)
+
+    def get_bin_edges(self) -> np.ndarray:
+        return np.linspace(self.range[0], self.range[1], self.bins + 1)
+
+
+def make_reductions(args: argparse.Namespace) -> List[Reduction]:
+    return ([Reduction('sum', spec) for spec in args.sum] + [Reduction('count', spec) for spec in args.count]
+            + [Reduction('histogram', spec) for spec in args.histogram])
+
+
+def get_spec_key(reductions: List[Reduction]) -> str:
+    """ Returns description of reductions. Cached partials are only valid for the same description. """
+    return json.dumps([[reduction.kind, reduction.name, reduction.expression, getattr(reduction, 'bins', None), getattr(reduction, 'range', None),
+                        getattr(reduction, 'weight', None)] for reduction in reductions])
+
+
+def to_identifier(name: str) -> str:
+    return re.sub(r'\W', '_', name)
+
+
+def reduce_file(J: int, K: int, sym: int, file_path: str, reductions: List[Reduction], chunk_size: int) -> Dict[str, np.ndarray]:
+    """ Computes partial results of all reductions for one state properties file, reading at most *chunk_size* states at a time. """
+    partials = {reduction.name: 0 for reduction in reductions}
+    with open(file_path) as states_file:
+        header = [to_identifier(name) for name in states_file.readline().split()]
+        first_state = 1
+        while True:
+            lines = list(itertools.islice(states_file, chunk_size))
+            if len(lines) == 0:
+                break
+            chunk = np.loadtxt(lines, ndmin=2)
+            names = header if len(header) == chunk.shape[1] else [f'col_{ind}' for ind in range(chunk.shape[1])]
+            namespace = {name: chunk[:, ind] for ind, name in enumerate(names)}
+            namespace.update(J=J, K=K, sym=sym, state=np.arange(first_state, first_state + chunk.shape[0]))
+            for reduction in reductions:
+                partials[reduction.name] = partials[reduction.name] + reduction.compute(namespace)
+            first_state += chunk.shape[0]
+    return partials
+
+
+def load_cache(cache_path: str, spec_key: str) -> Dict:
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as cache_file:
+        cache = json.load(cache_file)
+    return cache['files'] if cache['spec'] == spec_key else {}
+
+
+def save_cache(cache_path: str, spec_key: str, files: Dict):
+    with open(cache_path + '.tmp', 'w') as cache_file:
+        json.dump({'spec': spec_key, 'files': files}, cache_file)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def aggregate(root_path: str, reductions: List[Reduction], cache_path: str, workers: int, chunk_size: int) -> Dict[Tuple[int, int, int], Dict[str, np.ndarray]]:
+    """ Returns partial results of each (J, K, sym). Partials of unchanged files are taken from cache. """
+    spec_key = get_spec_key(reductions)
+    cached = load_cache(cache_path, spec_key)
+    files = find_states_files(root_path)
+    stats = {file_path: os.stat(file_path) for _, _, _, file_path in files}
+
+    def is_cached(file_path: str) -> bool:
+        entry = cached.get(file_path)
+        return entry is not None and entry['mtime'] == stats[file_path].st_mtime_ns and entry['size'] == stats[file_path].st_size
+
+    changed = [entry for entry in files if not is_cached(entry[3])]
+    print(f'Processing {len(changed)} out of {len(files)} files')
+    with ThreadPoolExecutor(workers) as executor:
+        new_partials = dict(zip([entry[3] for entry in changed],
+                                executor.map(lambda entry: reduce_file(*entry, reductions, chunk_size), changed)))
+
+    results = {}
+    new_cache = {}
+    for J, K, sym, file_path in files:
+        if file_path in new_partials:
+            partials = new_partials[file_path]
+        else:
+            partials = {name: np.array(value) for name, value in cached[file_path]['partials'].items()}
+        results[(J, K, sym)] = partials
+        new_cache[file_path] = {'mtime': stats[file_path].st_mtime_ns, 'size': stats[file_path].st_size,
+                                'partials': {name: np.asarray(value).tolist() for name, value in partials.items()}}
+    save_cache(cache_path, spec_key, new_cache)
+    return results
+
+
+def combine(partials_list: List[Dict[str, np.ndarray]], reductions: List[Reduction]) -> Dict[str, np.ndarray]:
+    return {reduction.name: sum((partials[reduction.name] for partials in partials_list), np.asarray(0.0)) for reduction in reductions}
+
+
+def main():
+    args = parse_command_line_args()
+    reductions = make_reductions(args)
+    if len(reductions) == 0:
+        raise Exception('No reductions are specified')
+    results = aggregate(args.root_path, reductions, args.cache, args.workers, args.chunk_size)
+    totals = combine(list(results.values()), reductions)
+    scalar_reductions = [reduction for reduction in reductions if reduction.kind != 'histogram']
+
+    output = {'totals': {name: value.tolist() for name, value in totals.items()}, 'groups': []}
+    for reduction in reductions:
+        if reduction.kind == 'histogram':
+            output['totals'][reduction.name + '_bin_edges'] = reduction.get_bin_edges().tolist()
+
+    if len(args.group_by) > 0:
+        key_inds = [['J', 'K', 'sym'].index(name) for name in args.group_by]
+        groups = {}
+        for key, partials in results.items():
+            groups.setdefault(tuple(key[ind] for ind in key_inds), []).append(partials)
+        print(''.join(f'{name:>8}' for name in args.group_by) + ''.join(f'{reduction.name:>20}' for reduction in scalar_reductions))
+        for group_key in sorted(groups):
+            group_totals = combine(groups[group_key], reductions)
+            print(''.join(f'{value:>8}' for value in group_key) + ''.join(f'{float(group_totals[reduction.name]):>20.10g}' for reduction in scalar_reductions))
+            output['groups'].append({**dict(zip(args.group_by, group_key)), **{name: value.tolist() for name, value in group_totals.items()}})
+
+    for reduction in scalar_reductions:
+        print(f'{reduction.name} = {float(totals[reduction.name]):.10g}')
+    with open(args.output, 'w') as output_file:
+        json.dump(output, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,23 @@
 #!/usr/bin/env python
+import functools
 import math
 import numpy as np
+from typing import Tuple
 
 from common import *
+from lookup_server import interpolate_table
 
 import sys
 sys.path.append('/global/u2/g/gaidai/SpectrumSDT_ifort/scripts/')
 from SpectrumSDTConfig import SpectrumSDTConfig
 
+known_Js = list(range(0, 33)) + list(range(36, 65, 4))
+known_Ks = list(range(0, 21))
 
-def estimate_states(Js, Ks, num_states_ref, J, K, mult):
-    """ Estimates necessary number of states for given J and K. Js and Ks are values of J and K for num_states_ref. """
-    states_interp = interpolate_JK(Js, Ks, num_states_ref, J, K)
+
+def estimate_states(states_interpolator, J, K, mult):
+    """ Estimates necessary number of states for given J and K using interpolator of reference number of states. """
+    states_interp = states_interpolator(J, K)
     states = int(math.ceil(states_interp * mult(K)))
     return states
 
@@ -26,27 +32,41 @@ def set_states_placeholder(states):
         config.truncate()
 
 
-def main():
-    """ Estimates necessary number of states for values J and K specified in config file and replaces num_states placeholder in config file with this number. """
-    Js = list(range(0, 33)) + list(range(36, 65, 4))
-    Ks = list(range(0, 21))
-    config = SpectrumSDTConfig('spectrumsdt.config')
+def get_states_reference(config: SpectrumSDTConfig) -> Tuple[str, str]:
+    """ Returns molecule and symmetry name of the reference number of states used for the given config. """
     mass = config.get_mass_str()
 
     molecule = get_ozone_molecule(mass)
     molecule = '666'
 
     sym_name = config.get_full_symmetry_name()
+    return molecule, sym_name
+
+
+def states_multiplier(K):
+    """ Returns the factor applied to the reference number of states for given K. """
+    return 1.15 + 0.02*K
+
 
-    mult = 1 if is_monoisotopomer(molecule) else 1/3
-    mult = lambda K: 1.15 + 0.02*K
+def get_states_table_path(molecule: str, sym_name: str) -> str:
+    return f'/global/u2/g/gaidai/nersc_scripts/ozone/script_data/num_states/{molecule}/sym_{sym_name}/num_states.txt'
 
-    load_path = f'/global/u2/g/gaidai/nersc_scripts/ozone/script_data/num_states/{molecule}/sym_{sym_name}/num_states.txt'
-    num_states_ref = np.loadtxt(load_path)
+
+def get_states_interpolator(molecule: str, sym_name: str) -> JKInterpolator:
+    """ Returns interpolator of the reference number of states for given molecule and symmetry. """
+    return JKInterpolator.from_file(known_Js, known_Ks, get_states_table_path(molecule, sym_name))
+
+
+def main():
+    """ Estimates necessary number of states for values J and K specified in config file and replaces num_states placeholder in config file with this number. """
+    config = SpectrumSDTConfig('spectrumsdt.config')
+    molecule, sym_name = get_states_reference(config)
+    # Uses lookup server if it is running
+    states_interpolator = functools.partial(interpolate_table, known_Js, known_Ks, get_states_table_path(molecule, sym_name))
 
     J = config.get_J()
     K = config.get_Ks()[0]  # Assuming sym top rotor
-    states = estimate_states(Js, Ks, num_states_ref, J, K, mult)
+    states = estimate_states(states_interpolator, J, K, states_multiplier)
     set_states_placeholder(states)
 
 
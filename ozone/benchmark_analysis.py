@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+import argparse
+import numpy as np
+import os
+import os.path as path
+import pathlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from benchmark_barriers import generate_energies
+from common import *
+from find_barriers import find_barriers, find_barriers_JK, get_lowest_barrier_info, interpolate_barrier_positions_JK, \
+    interpolate_barrier_positions_JK_batch, load_grid
+from find_num_states import read_num_states
+
+golden_path = pathlib.Path(__file__).resolve().parent / 'script_data' / 'benchmark_analysis'
+# Synthetic trees are made for a non-monoisotopic molecule, so that all 5 channels and 3 pathways are used
+molecule = '686'
+num_channels = 5
+target_energy = 1000
+# Same J and K as used by find_barriers.py and generate_wf_sections.py
+barrier_Js = list(range(0, 33, 2)) + list(range(36, 65, 4))
+barrier_Ks = list(range(0, 21, 2))
+# Tree sizes. Campaign is sized like a real one (J and K of find_num_states.py, 2 symmetries, 280 rho points)
+sizes = {
+    'small': {'Js': list(range(0, 17)) + list(range(20, 33, 4)), 'Ks': list(range(0, 11)), 'syms': [0], 'grid_points': 120, 'num_states': 300,
+              'num_queries': 200},
+    'campaign': {'Js': list(range(0, 33)) + list(range(36, 65, 4)), 'Ks': list(range(0, 21)), 'syms': [0, 1], 'grid_points': 280,
+                 'num_states': 2000, 'num_queries': 1000},
+}
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Builds a synthetic J/K/symmetry tree (rho_info.txt, energies_2d.fwc, states.fwc), times the analysis '
+                                                 'scripts on it (barriers, number of states, JK interpolation, barrier interpolation, wf sections) '
+                                                 'and checks the results against golden outputs')
+    parser.add_argument('-s', '--size', default='small', choices=list(sizes.keys()), help='Size of the synthetic tree')
+    parser.add_argument('-d', '--dir', help='Folder for the synthetic tree. Existing tree is reused. Default: temporary folder')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of repetitions of each timing (best time is reported)')
+    parser.add_argument('-sg', '--save-golden', action='store_true', help='Save the results as new golden outputs instead of checking them')
+
+    args = parser.parse_args()
+    return args
+
+
+def write_table(file_path: str, header: str, table: np.ndarray, fmt: str):
+    os.makedirs(path.dirname(file_path), exist_ok=True)
+    np.savetxt(file_path, table, fmt=fmt, header=header, comments='')
+
+
+def build_tree(root_path: str, size: Dict):
+    """ Writes rho grid, 2d energies of each (J, K, sym) and eigenstates with energies growing with J and K. Data are random, but reproducible. """
+    rng = np.random.default_rng(0)
+    grid = np.linspace(3.5, 11, size['grid_points'])
+    write_table(path.join(root_path, 'rho_info.txt'), 'rho jac', np.column_stack((grid, np.ones_like(grid))), '%25.16e')
+    for J in size['Js']:
+        for K in size['Ks']:
+            if K > J:
+                continue
+            for sym in size['syms']:
+                sym_path = path.join(root_path, f'J_{J}', f'K_{K}', f'symmetry_{sym}')
+                energies = generate_energies(grid, num_channels, seed=rng.integers(2**32))
+                write_table(path.join(sym_path, 'basis', 'energies_2d.fwc'), ' '.join(f'channel_{ind}' for ind in range(num_channels)), energies,
+                            '%25.16e')
+                lowest = -9000 + 0.8 * J * (J + 1) - 0.6 * K ** 2
+                states = np.sort(rng.uniform(lowest, lowest + 12000 + 40 * J, size['num_states']))
+                gammas = rng.exponential(0.1, size['num_states'])
+                write_table(path.join(sym_path, 'eigensolve', 'states.fwc'), 'Energy Gamma', np.column_stack((states, gammas)), '%25.16e')
+
+
+def timed(function: Callable, repeat: int) -> Tuple[object, float]:
+    """ Calls *function* *repeat* times. Returns result of the last call and the best time. """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def report(name: str, variant: str, elapsed: float, num_items: int):
+    print(f'{name:<24}{variant:<16}{num_items:>10}{elapsed:>12.4f}{elapsed / num_items * 1e6:>14.1f}')
+
+
+def bench_barriers(root_path: str, size: Dict, repeat: int) -> np.ndarray:
+    """ find_barriers.py: per-folder search vs all J/K at once """
+    grid = load_grid(root_path)
+    sym = size['syms'][0]
+
+    def per_folder():
+        barriers = np.zeros((len(barrier_Ks), len(barrier_Js), 3, 2))
+        for J_ind, J in enumerate(barrier_Js):
+            for K_ind, K in enumerate(barrier_Ks):
+                if K <= J:
+                    barriers[K_ind, J_ind] = find_barriers(root_path, molecule, J, K, sym, grid)
+        return barriers
+
+    barriers_ref, time_ref = timed(per_folder, repeat)
+    barriers, time_JK = timed(lambda: find_barriers_JK(root_path, molecule, barrier_Js, barrier_Ks, sym, grid), repeat)
+    num_folders = np.count_nonzero(barriers[:, :, 0, 0])
+    report('find_barriers', 'per folder', time_ref, num_folders)
+    report('find_barriers', 'all JK', time_JK, num_folders)
+    assert np.allclose(barriers, barriers_ref, rtol=1e-10, atol=1e-8), 'Barriers of find_barriers_JK do not match find_barriers'
+    return barriers
+
+
+def bench_num_states(root_path: str, size: Dict, repeat: int) -> np.ndarray:
+    """ find_num_states.py: full refresh vs incremental refresh with all files unchanged """
+    sym = size['syms'][0]
+    tasks = []
+    for J_ind, J in enumerate(size['Js']):
+        for K_ind, K in enumerate(size['Ks']):
+            if K <= J and not (J > 32 and K % 2 == 1):
+                tasks.append((J_ind, K_ind, path.join(root_path, f'J_{J}', f'K_{K}', f'symmetry_{sym}', 'eigensolve', 'states.fwc')))
+
+    def refresh(manifest: Dict) -> List[Dict]:
+        with ThreadPoolExecutor(16) as executor:
+            return list(executor.map(lambda task: read_num_states(task[2], target_energy, manifest.get(task[2])), tasks))
+
+    entries, time_full = timed(lambda: refresh({}), repeat)
+    manifest = {task[2]: entry for task, entry in zip(tasks, entries)}
+    _, time_incremental = timed(lambda: refresh(manifest), repeat)
+    report('find_num_states', 'full', time_full, len(tasks))
+    report('find_num_states', 'incremental', time_incremental, len(tasks))
+
+    num_states = np.zeros((len(size['Ks']), len(size['Js'])))
+    for (J_ind, K_ind, _), entry in zip(tasks, entries):
+        num_states[K_ind, J_ind] = entry['count']
+    return num_states
+
+
+def make_JK_queries(Js: List[int], Ks: List[int], num_queries: int) -> np.ndarray:
+    """ Returns random (J, K) points with K <= J within the given ranges """
+    rng = np.random.default_rng(1)
+    queries_J = rng.uniform(min(Js), max(Js), num_queries)
+    queries_K = rng.uniform(0, 1, num_queries) * np.minimum(queries_J, max(Ks))
+    return np.column_stack((queries_J, queries_K))
+
+
+def bench_interpolate_JK(size: Dict, num_states: np.ndarray, repeat: int) -> np.ndarray:
+    """ common.interpolate_JK (triangulation per call) vs JKInterpolator (triangulation once, vectorized call) """
+    queries = make_JK_queries(size['Js'], size['Ks'], size['num_queries'])
+    values_ref, time_ref = timed(lambda: np.array([interpolate_JK(size['Js'], size['Ks'], num_states, J, K) for J, K in queries]), repeat)
+    values, time_interpolator = timed(lambda: JKInterpolator(size['Js'], size['Ks'], num_states)(queries[:, 0], queries[:, 1]), repeat)
+    report('interpolate_JK', 'per query', time_ref, len(queries))
+    report('interpolate_JK', 'interpolator', time_interpolator, len(queries))
+    assert np.allclose(values, values_ref, rtol=1e-10, atol=1e-8, equal_nan=True), 'JKInterpolator does not match interpolate_JK'
+    return values
+
+
+def bench_barrier_positions(size: Dict, repeat: int) -> np.ndarray:
+    """ interpolate_barrier_positions_JK per query vs batched, both with a cold cache of channels tables (script_data) """
+    queries = np.array([(J, K, sym) for J in range(4, 57) for K in range(0, min(J, 20) + 1) for sym in [0, 1]])
+    queries = queries[::max(1, len(queries) // size['num_queries'])]
+
+    def per_query():
+        get_lowest_barrier_info.cache_clear()
+        return np.array([interpolate_barrier_positions_JK(molecule, J, K, sym) for J, K, sym in queries.tolist()])
+
+    def batch():
+        get_lowest_barrier_info.cache_clear()
+        return interpolate_barrier_positions_JK_batch(molecule, queries[:, 0], queries[:, 1], queries[:, 2])
+
+    positions_ref, time_ref = timed(per_query, repeat)
+    positions, time_batch = timed(batch, repeat)
+    report('barrier_positions_JK', 'per query', time_ref, len(queries))
+    report('barrier_positions_JK', 'batch', time_batch, len(queries))
+    assert np.allclose(positions, positions_ref, rtol=1e-10, atol=1e-8), 'Batched barrier positions do not match interpolate_barrier_positions_JK'
+    return positions
+
+
+def bench_wf_sections(root_path: str, size: Dict, barriers: np.ndarray, repeat: int) -> np.ndarray:
+    """ generate_wf_sections.py for each (J, K) of the tree, with VdW barriers interpolated from the barriers found in the tree """
+    try:
+        from generate_wf_sections import format_wf_sections, get_phi_barriers, get_vdw_barriers
+    except ImportError as error:
+        print(f'Skipping generate_wf_sections ({error})')
+        return None
+
+    barriers_path = path.join(root_path, 'barriers')
+    for ind, pathway in enumerate(['B', 'A', 'S']):
+        write_table(path.join(barriers_path, molecule, 'sym_0', pathway, 'barriers.txt'), '', barriers[:, :, ind, 0], '%25.16e')
+    phi_barriers = get_phi_barriers(molecule)
+    configs = [(J, K) for J in size['Js'] for K in size['Ks'] if K <= J]
+
+    def generate():
+        vdw_barriers = []
+        for J, K in configs:
+            config_barriers = get_vdw_barriers(molecule, '0', barrier_Js, barrier_Ks, J, K, barriers_path)
+            format_wf_sections(molecule, config_barriers, phi_barriers, [K, K])
+            vdw_barriers.append(list(config_barriers.values()))
+        return np.array(vdw_barriers, dtype=float)
+
+    vdw_barriers, elapsed = timed(generate, repeat)
+    report('generate_wf_sections', 'per config', elapsed, len(configs))
+    return vdw_barriers
+
+
+def check_golden(results: Dict[str, np.ndarray], golden_file: pathlib.Path):
+    if not golden_file.exists():
+        print(f'No golden outputs at {golden_file} (use --save-golden to make them)')
+        return
+    mismatches = []
+    with np.load(golden_file) as golden:
+        for name in golden.files:
+            if name not in results:
+                print(f'Golden output {name} was not checked')
+            elif not np.allclose(results[name], golden[name], rtol=1e-10, atol=1e-8, equal_nan=True):
+                mismatches.append(name)
+    assert len(mismatches) == 0, f'Results do not match golden outputs: {", ".join(mismatches)}'
+    print(f'Results match golden outputs ({golden_file.name})')
+
+
+def run(root_path: str, args: argparse.Namespace):
+    size = sizes[args.size]
+    if not path.exists(path.join(root_path, 'rho_info.txt')):
+        start = time.perf_counter()
+        build_tree(root_path, size)
+        print(f'Built {args.size} tree at {root_path} in {time.perf_counter() - start:.1f} s')
+
+    print(f'{"path":<24}{"variant":<16}{"items":>10}{"time, s":>12}{"per item, us":>14}')
+    results = {'barriers': bench_barriers(root_path, size, args.repeat)}
+    results['num_states'] = bench_num_states(root_path, size, args.repeat)
+    results['num_states_interp'] = bench_interpolate_JK(size, results['num_states'], args.repeat)
+    results['barrier_positions'] = bench_barrier_positions(size, args.repeat)
+    vdw_barriers = bench_wf_sections(root_path, size, results['barriers'], args.repeat)
+    if vdw_barriers is not None:
+        results['vdw_barriers'] = vdw_barriers
+
+    golden_file = golden_path / f'{args.size}.npz'
+    if args.save_golden:
+        golden_path.mkdir(parents=True, exist_ok=True)
+        np.savez(golden_file, **results)
+        print(f'Saved golden outputs to {golden_file}')
+    else:
+        check_golden(results, golden_file)
+
+
+def main():
+    args = parse_command_line_args()
+    if args.dir is not None:
+        run(path.abspath(args.dir), args)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            run(work_dir, args)
+
+
+if __name__ == '__main__':
+    main()
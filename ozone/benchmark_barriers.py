@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+import numpy as np
+import scipy.signal as signal
+import time
+
+from find_barriers import *
+
+
+def generate_energies(grid, num_curves, seed=0):
+    """ Generates synthetic ground energy pathways (grid x curves) with a single barrier near rho=5.3 and a VdW tail. """
+    rng = np.random.default_rng(seed)
+    barrier_positions = rng.uniform(5.0, 5.6, num_curves)
+    barrier_heights = rng.uniform(500, 1500, num_curves)
+    barrier_widths = rng.uniform(0.2, 0.5, num_curves)
+    well_depths = rng.uniform(5000, 9000, num_curves)
+    energies = (barrier_heights * np.exp(-((grid[:, np.newaxis] - barrier_positions) / barrier_widths) ** 2)
+                - well_depths * np.exp(-((grid[:, np.newaxis] - 4.0) / 0.5) ** 2))
+    return energies
+
+
+def locate_barriers_reference(grid, energies):
+    """ Per-channel barrier search as done originally in find_barriers (scipy peak search and polynomial fit). """
+    barriers = np.zeros((energies.shape[1], 2))
+    for ch_ind in range(energies.shape[1]):
+        peaks = signal.find_peaks(energies[:, ch_ind], height=(-5000, 5000))[0]
+        barriers[ch_ind, :] = interpolate_energies_2d(grid[peaks[0] - 1 : peaks[0] + 2], energies[peaks[0] - 1 : peaks[0] + 2, ch_ind])
+    return barriers
+
+
+def main():
+    grid = np.linspace(3.5, 11, 280)
+    num_curves = 5 * 300  # 5 channels for ~300 J/K/symmetry combinations
+    energies = generate_energies(grid, num_curves)
+
+    start = time.perf_counter()
+    barriers_ref = locate_barriers_reference(grid, energies)
+    time_ref = time.perf_counter() - start
+
+    start = time.perf_counter()
+    barriers_vec = np.stack(locate_barriers(grid, energies), axis=-1)
+    time_vec = time.perf_counter() - start
+
+    max_diff = np.max(np.abs(barriers_vec - barriers_ref), axis=0)
+    print(f'Curves: {num_curves}, grid points: {len(grid)}')
+    print(f'Per-channel path: {time_ref:.4f} s')
+    print(f'Vectorized path: {time_vec:.4f} s (speedup {time_ref / time_vec:.1f}x)')
+    print(f'Max difference in position: {max_diff[0]:.3e}, energy: {max_diff[1]:.3e}')
+    assert np.allclose(barriers_vec, barriers_ref, rtol=1e-10, atol=1e-8), 'Vectorized barriers do not match the reference'
+
+
+if __name__ == '__main__':
+    main()
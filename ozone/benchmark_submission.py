@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import argparse
+import os
+import os.path as path
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict
+
+from slurm_standin import db_name
+
+script_dir = path.dirname(path.abspath(__file__))
+standin_path = path.join(script_dir, "slurm_standin.py")
+# Stand-ins of the modules imported from the SpectrumSDT install (SpectrumSDTConfig)
+standin_modules_path = path.join(script_dir, "standin")
+parallel_pes_path = path.join(script_dir, "..", "MolproGenerator", "parallel_pes.py")
+chain_stages = ["basis", "overlaps", "diagonalization", "properties"]
+# Explicit resources and job name, so that o3_submit.py does not need grids or a real campaign path
+submit_options = "-n 1 -np 32 -jn benchmark -pl /tmp"
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Drives a synthetic campaign through submission and chaining against slurm_standin.py "
+                                                 "and reports submission throughput and per-job overhead of our scripts")
+    parser.add_argument("-n", "--folders", type=int, default=1000, help="Number of campaign folders")
+    parser.add_argument("-l", "--latency", type=float, default=0, help="Injected latency of each slurm command (seconds)")
+    parser.add_argument("-s", "--scenarios", nargs="+", default=["pes", "submit", "chain"], choices=["pes", "submit", "chain"],
+                        help="pes - parallel_pes.py submission of one point per folder, submit - o3_submit.py in each folder, "
+                             "chain - chain_call_next_stage.py through all stages of each folder")
+
+    args = parser.parse_args()
+    return args
+
+
+def init_standin(work_dir: str, latency: float, execute: bool) -> Dict[str, str]:
+    """ Creates a fresh stand-in and returns environment that uses it """
+    standin_dir = path.join(work_dir, "standin")
+    subprocess.check_call([sys.executable, standin_path, "--dir", standin_dir, "init", "--latency", str(latency)] + (["--execute"] if execute else []),
+                          stdout=subprocess.DEVNULL)
+    env = dict(os.environ, SLURM_STANDIN_DIR=standin_dir, O3_BIN_PATH=script_dir)
+    env["PATH"] = path.join(standin_dir, "bin") + os.pathsep + env["PATH"]
+    env["PYTHONPATH"] = os.pathsep.join([standin_modules_path] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    env.setdefault("HOST", "cori01")
+    return env
+
+
+def summarize(name: str, env: Dict[str, str], elapsed: float):
+    connection = sqlite3.connect(path.join(env["SLURM_STANDIN_DIR"], db_name))
+    num_jobs = connection.execute("select count(*) from jobs").fetchone()[0]
+    standin_time = connection.execute("select coalesce(sum(duration), 0) from calls").fetchone()[0]
+    connection.close()
+    print("{0:<8}{1:>8}{2:>12.2f}{3:>14.1f}{4:>16.2f}{5:>18.1f}".format(
+        name, num_jobs, elapsed, num_jobs / elapsed, standin_time, (elapsed - standin_time) / num_jobs * 1000))
+
+
+def run_pes(work_dir: str, args: argparse.Namespace):
+    """ One parallel_pes.py call that submits a point per folder """
+    env = init_standin(work_dir, args.latency, False)
+    pes_dir = path.join(work_dir, "pes")
+    os.makedirs(pes_dir)
+    template_path = path.join(pes_dir, "template.inp")
+    with open(template_path, "w") as template:
+        template.write("r=((name=r|range=[1,{0},1]))\n".format(args.folders))
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, parallel_pes_path, template_path], cwd=pes_dir, env=env, stdout=subprocess.DEVNULL)
+    summarize("pes", env, time.perf_counter() - start)
+
+
+def make_campaign(campaign_dir: str, num_folders: int, stages: list):
+    for ind in range(num_folders):
+        for stage in stages:
+            stage_dir = path.join(campaign_dir, "folder_{0}".format(ind), stage)
+            os.makedirs(stage_dir)
+            open(path.join(stage_dir, "spectrumsdt.config"), "w").close()
+
+
+def run_submit(work_dir: str, args: argparse.Namespace):
+    """ o3_submit.py in each folder, as done by execute_all.py """
+    env = init_standin(work_dir, args.latency, False)
+    campaign_dir = path.join(work_dir, "submit")
+    make_campaign(campaign_dir, args.folders, ["properties"])
+    start = time.perf_counter()
+    for ind in range(args.folders):
+        subprocess.check_call(path.join(script_dir, "o3_submit.py") + " " + submit_options, shell=True, env=env,
+                              cwd=path.join(campaign_dir, "folder_{0}".format(ind), "properties"), stdout=subprocess.DEVNULL)
+    summarize("submit", env, time.perf_counter() - start)
+
+
+def run_chain(work_dir: str, args: argparse.Namespace):
+    """ chain_call_next_stage.py in each folder. Jobs are executed right at submission, so each job submits the next stage. """
+    env = init_standin(work_dir, args.latency, True)
+    campaign_dir = path.join(work_dir, "chain")
+    make_campaign(campaign_dir, args.folders, chain_stages)
+    start = time.perf_counter()
+    for ind in range(args.folders):
+        subprocess.check_call([path.join(script_dir, "chain_call_next_stage.py"), "-so", submit_options + ";;;;"], env=env,
+                              cwd=path.join(campaign_dir, "folder_{0}".format(ind), "basis"), stdout=subprocess.DEVNULL)
+    summarize("chain", env, time.perf_counter() - start)
+
+
+def main():
+    args = parse_command_line_args()
+    scenarios = {"pes": run_pes, "submit": run_submit, "chain": run_chain}
+    print("Folders: {0}, injected latency: {1:g} s".format(args.folders, args.latency))
+    print("{0:<8}{1:>8}{2:>12}{3:>14}{4:>16}{5:>18}".format("scenario", "jobs", "elapsed, s", "submissions/s", "slurm time, s", "overhead/job, ms"))
+    with tempfile.TemporaryDirectory() as work_dir:
+        for scenario in args.scenarios:
+            scenarios[scenario](path.join(work_dir, scenario), args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,19 @@
 import argparse
 import subprocess
 import os
+import os.path as path
 from typing import List, Tuple
 
+# Folder with deployed scripts (can be changed to run chains against a local copy, e.g. with slurm_standin.py)
+bin_path = os.environ.get("O3_BIN_PATH", "/global/homes/g/gaidai/bin")
+
 
 class StageManager:
     def __init__(self, args: argparse.Namespace):
         # paths to job stages relative to previous stages
         self.stage_paths = [".", "../overlaps", "../diagonalization", "../properties"]
-        self.submission_script_path = "/global/homes/g/gaidai/bin/o3_submit.py"
-        self.chain_script_path = "/global/homes/g/gaidai/bin/chain_call_next_stage.py"
+        self.submission_script_path = path.join(bin_path, "o3_submit.py")
+        self.chain_script_path = path.join(bin_path, "chain_call_next_stage.py")
         self.stage_options = args.stage_options.split(";")  # type: List[str]
         self.stage_options += [""] * (len(self.stage_paths) + 1 - len(self.stage_options))  # pad array to match number of stages
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import numpy as np
+import os
+import pathlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
+
+script_data_path = pathlib.Path(__file__).resolve().parent / 'script_data'
+store_path = script_data_path / 'channels_store.npz'
+symmetry_codes = {'S': 0, 'A': 1}
+symmetry_letters = {code: letter for letter, code in symmetry_codes.items()}
+# mtime and size of each source file are recorded, so that entries of changed files can be detected as stale
+index_dtype = np.dtype([('molecule', 'U3'), ('J', 'i4'), ('K', 'i4'), ('sym', 'i4'), ('offset', 'i8'), ('count', 'i8'), ('mtime', 'i8'),
+                        ('size', 'i8')])
+num_groups = 3
+
+
+def lowest_barrier_positions(channels: np.ndarray) -> np.ndarray:
+    """ Returns positions of lowest barrier tops in channel groups (columns 2 and 3 of channels file) in the order of groups.
+    Channels are assumed to be sorted by energy, so the first channel of each group is taken. Missing groups get 0. """
+    groups = channels[:, 1].astype(int) - 1
+    positions = np.zeros(num_groups)
+    for group_ind in range(num_groups):
+        group_rows = np.where(groups == group_ind)[0]
+        if len(group_rows) > 0:
+            positions[group_ind] = channels[group_rows[0], 2]
+    return positions
+
+
+def find_channels_files(data_path: pathlib.Path) -> List[Tuple[str, int, int, int, pathlib.Path]]:
+    """ Finds all channels files in *data_path* and returns (molecule, J, K, sym, path) for each, sorted by key. """
+    files = []
+    for file_path in data_path.glob('*_full/J??/K??[AS]/channels.dat'):
+        molecule = file_path.parts[-4][:-len('_full')]
+        J = int(file_path.parts[-3][1:])
+        K_match = re.fullmatch(r'K(\d\d)([AS])', file_path.parts[-2])
+        files.append((molecule, J, int(K_match.group(1)), symmetry_codes[K_match.group(2)], file_path))
+    return sorted(files)
+
+
+def get_channels_file_path(data_path: pathlib.Path, molecule: str, J: int, K: int, sym: int) -> pathlib.Path:
+    """ Returns path to the channels file of the given arguments in *data_path* (inverse of find_channels_files). """
+    return data_path / f'{molecule}_full' / f'J{J:02}' / f'K{K:02}{symmetry_letters[sym]}' / 'channels.dat'
+
+
+def build_store(data_path: pathlib.Path = script_data_path, output_path: pathlib.Path = store_path):
+    """ Packs all channels files in *data_path* into a single npz file with a (molecule, J, K, sym) index.
+    Text files remain the source of truth: entries of files changed after packing are not used (see ChannelsStore.find_stale_keys). """
+    channels_files = find_channels_files(data_path)
+    index = np.zeros(len(channels_files), dtype=index_dtype)
+    tables = []
+    offset = 0
+    for ind, (molecule, J, K, sym, file_path) in enumerate(channels_files):
+        table = np.loadtxt(file_path, ndmin=2)
+        file_stat = file_path.stat()
+        index[ind] = (molecule, J, K, sym, offset, table.shape[0], file_stat.st_mtime_ns, file_stat.st_size)
+        tables.append(table)
+        offset += table.shape[0]
+    channels = np.concatenate(tables) if len(tables) > 0 else np.zeros((0, 7))
+    lowest_barriers = np.array([lowest_barrier_positions(table) for table in tables]).reshape(-1, num_groups)
+    np.savez(output_path, index=index, channels=channels, lowest_barriers=lowest_barriers)
+    print(f'Packed {len(channels_files)} channels files into {output_path}')
+
+
+class ChannelsStore:
+    """ In-memory view of the packed channels store. Entries are validated against their channels files once, when the store is opened. """
+    def __init__(self, path: pathlib.Path = store_path, data_path: pathlib.Path = script_data_path):
+        with np.load(path) as store:
+            self.index = store['index']
+            self.channels = store['channels']
+            self.lowest_barriers = store['lowest_barriers']
+        self.lookup = {(str(entry['molecule']), int(entry['J']), int(entry['K']), int(entry['sym'])): ind
+                       for ind, entry in enumerate(self.index)}  # type: Dict[Tuple[str, int, int, int], int]
+        self.stale = self.find_stale_keys(data_path)
+
+    def __contains__(self, key: Tuple[str, int, int, int]) -> bool:
+        return key in self.lookup
+
+    def find_stale_keys(self, data_path: pathlib.Path) -> Set[Tuple[str, int, int, int]]:
+        """ Returns keys of the entries whose channels files changed (or disappeared) after packing, by comparing mtimes and sizes
+        recorded in the index. Files are checked in parallel, since metadata calls are slow on network filesystems.
+        All entries of stores built before mtimes and sizes were recorded are stale. """
+        if 'mtime' not in self.index.dtype.names:
+            return set(self.lookup)
+
+        def is_stale(key: Tuple[str, int, int, int]) -> bool:
+            entry = self.index[self.lookup[key]]
+            try:
+                file_stat = os.stat(get_channels_file_path(data_path, *key))
+            except OSError:
+                return True
+            return entry['mtime'] != file_stat.st_mtime_ns or entry['size'] != file_stat.st_size
+
+        keys = list(self.lookup)
+        with ThreadPoolExecutor(16) as executor:
+            return {key for key, stale in zip(keys, executor.map(is_stale, keys)) if stale}
+
+    def is_current(self, key: Tuple[str, int, int, int]) -> bool:
+        """ Returns True if the store has an entry of *key* packed from the current version of its channels file. """
+        return key in self.lookup and key not in self.stale
+
+    def get_channels(self, molecule: str, J: int, K: int, sym: int) -> np.ndarray:
+        """ Returns the channels table corresponding to the given arguments. """
+        entry = self.index[self.lookup[(molecule, J, K, sym)]]
+        return self.channels[entry['offset'] : entry['offset'] + entry['count']]
+
+    def get_lowest_barrier_info(self, molecule: str, J: int, K: int, sym: int) -> List[float]:
+        """ Returns positions of lowest barrier tops in channels A, B and S corresponding to the given arguments. """
+        return self.lowest_barriers[self.lookup[(molecule, J, K, sym)]].tolist()
+
+
+_loaded_store = None
+
+
+def get_channels_store() -> ChannelsStore:
+    """ Returns the packed channels store, loading it on first use. Returns None if the store has not been built. """
+    global _loaded_store
+    if _loaded_store is None and store_path.is_file():
+        _loaded_store = ChannelsStore(store_path)
+    return _loaded_store
+
+
+if __name__ == '__main__':
+    build_store()
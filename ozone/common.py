@@ -1,5 +1,9 @@
+from __future__ import annotations
+
 import numpy as np
-from scipy.interpolate import griddata
+import os
+import os.path as path
+import pickle
 
 
 def is_monoisotopomer(molecule):
@@ -25,8 +29,49 @@ def arrange_interp_data(Js, Ks, vals):
 
 def interpolate_JK(Js, Ks, vals, J, K):
     """ Estimates necessary number of states for given J and K. Js and Ks are values of J and K for vals. """
+    from scipy.interpolate import griddata  # imported here, since scipy is slow to import and most callers do not need it
     interp_data = arrange_interp_data(Js, Ks, vals)
     val_interp = griddata(interp_data[:, 0:2], interp_data[:, 2], (J, K))
     return val_interp
 
 
+class JKInterpolator:
+    """ Linear interpolator of a (J, K) table. Equivalent to interpolate_JK, but the triangulation is built only once.
+    Can be called with scalars or arrays of J and K. """
+    def __init__(self, Js, Ks, vals):
+        from scipy.interpolate import LinearNDInterpolator
+        interp_data = arrange_interp_data(Js, Ks, vals)
+        self.interpolator = LinearNDInterpolator(interp_data[:, 0:2], interp_data[:, 2])
+
+    def __call__(self, J, K):
+        return self.interpolator((J, K))
+
+    @staticmethod
+    def get_cache_path(table_path: str) -> str:
+        """ Returns path to the cached interpolator for the table at *table_path*. """
+        return path.splitext(table_path)[0] + '_interp.pkl'
+
+    @classmethod
+    def from_file(cls, Js, Ks, table_path: str) -> JKInterpolator:
+        """ Builds an interpolator for the table saved at *table_path*. The interpolator is cached next to the table
+        and reused by later calls as long as the table and the values of J and K stay the same. """
+        table_stat = os.stat(table_path)
+        cache_key = (list(Js), list(Ks), table_stat.st_mtime_ns, table_stat.st_size)
+        cache_path = cls.get_cache_path(table_path)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                cached = pickle.load(cache_file)
+            if cached['key'] == cache_key:
+                return cached['interpolator']
+        except Exception:
+            pass  # cache is optional: missing, corrupted or written by other versions of scipy/numpy, rebuilt below
+
+        interpolator = cls(Js, Ks, np.loadtxt(table_path))
+        try:
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as cache_file:
+                pickle.dump({'key': cache_key, 'interpolator': interpolator}, cache_file)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass  # cache is optional, e.g. script_data may be read-only
+        return interpolator
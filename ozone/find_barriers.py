@@ -1,12 +1,13 @@
 #!/usr/bin/env python
+import functools
 import numpy as np
 from numpy.polynomial import Polynomial
 import os
 import os.path as path
 import pathlib
-import scipy.signal as signal
-from typing import List
+from typing import List, Tuple
 
+from channels_store import get_channels_store
 from common import *
 
 
@@ -23,7 +24,8 @@ def is_heavy(molecule):
 
 
 def interpolate_energies_2d(grid, energies):
-    """ Fits a parabola to given energies and returns its extremum point (barrier). """
+    """ Fits a parabola to given energies and returns its extremum point (barrier).
+    Reference implementation of parabola_vertex_3pt, used to check it in benchmark_barriers.py. """
     parabola = Polynomial.fit(grid, energies, 2)
     parabola_coefs = parabola.convert().coef
     barrier_position = -parabola_coefs[1] / 2 / parabola_coefs[2]
@@ -31,27 +33,89 @@ def interpolate_energies_2d(grid, energies):
     return barrier_position, barrier_energy
 
 
-def find_barriers(root_path, molecule, J, K, sym, grid):
-    """ Reads 2d energies for given arguments, finds the peaks in the ground energy pathways and interpolates barrier positions. """
+def parabola_vertex_3pt(x: np.ndarray, y: np.ndarray):
+    """ Returns position and value of the extremum of the parabola passing through 3 points. Points are stacked along the last axis. """
+    slope_01 = (y[..., 1] - y[..., 0]) / (x[..., 1] - x[..., 0])
+    slope_12 = (y[..., 2] - y[..., 1]) / (x[..., 2] - x[..., 1])
+    curvature = (slope_12 - slope_01) / (x[..., 2] - x[..., 0])
+    linear = slope_01 - curvature * (x[..., 0] + x[..., 1])
+    vertex_position = -linear / 2 / curvature
+    vertex_value = y[..., 0] + (vertex_position - x[..., 0]) * (slope_01 + curvature * (vertex_position - x[..., 1]))
+    return vertex_position, vertex_value
+
+
+def locate_barriers(grid: np.ndarray, energies: np.ndarray, height=(-5000, 5000)):
+    """ Vectorized barrier search. *energies* has the grid along the first axis and any number of trailing axes (channels, J, K, ...).
+    Finds the first strict local maximum within *height* window along the grid and fits a parabola through it and its 2 neighbours.
+    Returns barrier positions and energies with the shape of the trailing axes of *energies*. Curves without a peak get NaN. """
+    middle = energies[1:-1]
+    is_peak = (middle > energies[:-2]) & (middle > energies[2:]) & (middle >= height[0]) & (middle <= height[1])
+    has_peak = is_peak.any(axis=0)
+    peak_ind = is_peak.argmax(axis=0) + 1
+
+    stencil = peak_ind[..., np.newaxis] + np.arange(-1, 2)
+    x = grid[stencil]
+    y = np.take_along_axis(np.moveaxis(energies, 0, -1), stencil, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        positions, barrier_energies = parabola_vertex_3pt(x, y)
+    positions = np.where(has_peak, positions, np.nan)
+    barrier_energies = np.where(has_peak, barrier_energies, np.nan)
+    return positions, barrier_energies
+
+
+def order_barriers(barriers: np.ndarray, molecule: str) -> np.ndarray:
+    """ Selects lowest energy pathways from *barriers* (..., channels, 2) and orders them by position (B, A, S). """
+    num_pathways = 1 if is_monoisotopomer(molecule) else 3
+    barriers = np.take_along_axis(barriers, barriers[..., 1].argsort(axis=-1)[..., np.newaxis], axis=-2)  # sort by energy
+    barriers = barriers[..., :num_pathways, :]
+    barriers = np.take_along_axis(barriers, barriers[..., 0].argsort(axis=-1)[..., np.newaxis], axis=-2)  # sort by position
+    if not is_heavy(molecule):
+        barriers = barriers[..., ::-1, :]  # light molecules have inverse barrier order
+    return barriers
+
+
+def load_energies_2d(root_path, molecule, J, K, sym):
+    """ Loads 2d energies of the channels used to search for barriers. Returns None if the energies do not exist. """
     energies_path = path.join(root_path, f'J_{J}', f'K_{K}', f'symmetry_{sym}', 'basis', 'energies_2d.fwc')
-    monoisotopomer = is_monoisotopomer(molecule)
-    num_pathways = 1 if monoisotopomer else 3
-    if path.exists(energies_path):
-        load_channels = 1 if monoisotopomer else 5
-        energies = np.loadtxt(energies_path, skiprows=1, usecols=list(range(load_channels)))
-        energies = energies.reshape(energies.shape[0], -1)
-
-        barriers = np.zeros((load_channels, 2))  # barrier positions and energies
-        for ch_ind in range(load_channels):
-            peaks = signal.find_peaks(energies[:, ch_ind], height=(-5000, 5000))[0]
-            barriers[ch_ind, :] = interpolate_energies_2d(grid[peaks[0] - 1 : peaks[0] + 2], energies[peaks[0] - 1 : peaks[0] + 2, ch_ind])
-        barriers = barriers[barriers[:, 1].argsort(), :]  # sort by energy
-        barriers = barriers[barriers[:num_pathways, 0].argsort(), :]  # sort lowest pathway energies by position
-        if not is_heavy(molecule):
-            barriers = barriers[::-1, :]  # light molecules have inverse barrier order
-    else:
-        barriers = np.zeros((num_pathways, 2))
+    if not path.exists(energies_path):
+        return None
+    load_channels = 1 if is_monoisotopomer(molecule) else 5
+    energies = np.loadtxt(energies_path, skiprows=1, usecols=list(range(load_channels)))
+    return energies.reshape(energies.shape[0], -1)
 
+
+def find_barriers(root_path, molecule, J, K, sym, grid):
+    """ Reads 2d energies for given arguments, finds the peaks in the ground energy pathways and interpolates barrier positions. """
+    num_pathways = 1 if is_monoisotopomer(molecule) else 3
+    energies = load_energies_2d(root_path, molecule, J, K, sym)
+    if energies is None:
+        return np.zeros((num_pathways, 2))
+    barriers = np.stack(locate_barriers(grid, energies), axis=-1)  # barrier positions and energies
+    return order_barriers(barriers, molecule)
+
+
+def find_barriers_JK(root_path, molecule, Js, Ks, sym, grid):
+    """ Same as find_barriers, but for all combinations of *Js* and *Ks* at once. Barriers of all channels and J/K pairs are located
+    in a single vectorized call. Returns array of shape (len(Ks), len(Js), pathways, 2), with zeros for missing or K > J data. """
+    num_pathways = 1 if is_monoisotopomer(molecule) else 3
+    barriers = np.zeros((len(Ks), len(Js), num_pathways, 2))
+    found_inds = []
+    found_energies = []
+    for J_ind, J in enumerate(Js):
+        for K_ind, K in enumerate(Ks):
+            if K > J:
+                continue
+            energies = load_energies_2d(root_path, molecule, J, K, sym)
+            if energies is not None:
+                found_inds.append((K_ind, J_ind))
+                found_energies.append(energies)
+
+    if len(found_energies) > 0:
+        energies = np.stack(found_energies, axis=-1)  # rho x channels x JK
+        found_barriers = np.stack(locate_barriers(grid, energies), axis=-1)  # channels x JK x 2
+        found_barriers = order_barriers(np.moveaxis(found_barriers, 1, 0), molecule)
+        K_inds, J_inds = zip(*found_inds)
+        barriers[list(K_inds), list(J_inds)] = found_barriers
     return barriers
 
 
@@ -115,6 +179,17 @@ def load_lowest_barrier_info(channels_file_path: str) -> List[float]:
     return barrier_positions
 
 
+@functools.lru_cache(maxsize=4096)
+def get_lowest_barrier_info(molecule: str, J: int, K: int, sym: int) -> Tuple[float, ...]:
+    """ Returns positions of lowest barrier tops in channels A, B and S for given arguments.
+    Served from the packed channels store if it has been built and the channels file has not changed since, otherwise read from the file.
+    Results are cached, so each channels table is loaded at most once per process. """
+    store = get_channels_store()
+    if store is not None and store.is_current((molecule, J, K, sym)):
+        return tuple(store.get_lowest_barrier_info(molecule, J, K, sym))
+    return tuple(load_lowest_barrier_info(get_channels_file_path(molecule, J, K, sym)))
+
+
 def linear_interpolation_1d(point1: List[float], point2: List[float], query_x: float) -> float:
     """ Uses 2 (x, y) points to linearly interpolate the value at *query_x*. """
     return (point2[1] - point1[1]) / (point2[0] - point1[0]) * (query_x - point1[0]) + point1[1]
@@ -137,8 +212,7 @@ def interpolate_barrier_positions_JK(molecule: str, J: int, K: int, symmetry: in
     barrier_positions_known = [[0]*len(Ks_interp) for i in range(len(Js_interp))]
     for i in range(len(Js_interp)):
         for j in range(len(Ks_interp)):
-            channels_file_path = get_channels_file_path(molecule, Js_interp[i], Ks_interp[j], symmetry)
-            lowest_barriers = load_lowest_barrier_info(channels_file_path)
+            lowest_barriers = get_lowest_barrier_info(molecule, Js_interp[i], Ks_interp[j], symmetry)
             barrier_positions_known[i][j] = lowest_barriers
 
     # Interpolate barrier positions (B, A, S)
@@ -152,6 +226,37 @@ def interpolate_barrier_positions_JK(molecule: str, J: int, K: int, symmetry: in
     return barrier_positions
 
 
+def interpolate_barrier_positions_JK_batch(molecule: str, Js, Ks, symmetries) -> np.ndarray:
+    """ Batched version of interpolate_barrier_positions_JK. *Js*, *Ks* and *symmetries* are broadcast against each other.
+    Returns array of interpolated barrier positions (B, A, S) with shape (*broadcast_shape, 3). """
+    Js, Ks, symmetries = np.broadcast_arrays(np.asarray(Js), np.asarray(Ks), np.asarray(symmetries))
+
+    # Same selection as in select_interpolating_Js and select_interpolating_Ks
+    step_K = 2
+    J_low = np.where(Js <= 8, 4, np.where(Js >= 52, 52, Js // 4 * 4)).astype(int)
+    J_high = J_low + 4
+    max_K = np.minimum(J_low // step_K, 20)
+    at_max_K = Ks >= max_K - step_K
+    K_low = np.where(at_max_K, np.maximum(max_K - step_K, 0), Ks // step_K * step_K).astype(int)
+    K_high = np.where(at_max_K, max_K, K_low + step_K).astype(int)
+
+    # Load known barrier positions at the corners for interpolation
+    def load_corner(J_corner: np.ndarray, K_corner: np.ndarray) -> np.ndarray:
+        keys = zip(J_corner.ravel().tolist(), K_corner.ravel().tolist(), symmetries.ravel().tolist())
+        barriers = [get_lowest_barrier_info(molecule, J, K, sym) for J, K, sym in keys]
+        return np.array(barriers).reshape(Js.shape + (-1, ))
+    barriers_00 = load_corner(J_low, K_low)
+    barriers_10 = load_corner(J_high, K_low)
+    barriers_01 = load_corner(J_low, K_high)
+
+    # Same arithmetic as in linear_interpolation_2d
+    J_delta = (Js - J_low)[..., np.newaxis]
+    K_delta = (Ks - K_low)[..., np.newaxis]
+    interp1 = (barriers_10 - barriers_00) / (J_high - J_low)[..., np.newaxis] * J_delta + barriers_00
+    interp2 = (barriers_01 - barriers_00) / (K_high - K_low)[..., np.newaxis] * K_delta + barriers_00
+    return interp1 + interp2 - barriers_00
+
+
 def main():
     grid_path = '/global/cfs/cdirs/m409/gaidai/ozone/dev/666'
     root_path = '/global/cfs/cdirs/m409/gaidai/ozone/dev/666'
@@ -162,20 +267,15 @@ def main():
     Js = list(range(0, 33, 2)) + list(range(36, 65, 4))
     Ks = list(range(0, 21, 2))
 
-    barriers = np.zeros((len(Ks), len(Js), len(pathways), 2))  # last dim: position, energy
     grid = load_grid(grid_path)
-    for J_ind, J in enumerate(Js):
-        for K_ind, K in enumerate(Ks):
-            if K > J:
-                continue
-            barriers[K_ind, J_ind, :, :] = find_barriers(root_path, molecule, J, K, sym, grid)
-
-            #  if molecule == '686' or molecule == '868':
-            #      # Assuming the only symmetries in this case are 0 or 1
-            #      K_sym = sym if K % 2 == 0 else 1 - sym
-            #      barriers[K_ind, J_ind, :] = interpolate_barrier_positions_JK(molecule, J, K, K_sym)
-            #  else:
-            #      barriers[K_ind, J_ind, :] = find_barriers(root_path, molecule, J, K, sym, grid)
+    barriers = find_barriers_JK(root_path, molecule, Js, Ks, sym, grid)  # last dim: position, energy
+
+    #  if molecule == '686' or molecule == '868':
+    #      # Assuming the only symmetries in this case are 0 or 1
+    #      for J_ind, J in enumerate(Js):
+    #          for K_ind, K in enumerate(Ks):
+    #              K_sym = sym if K % 2 == 0 else 1 - sym
+    #              barriers[K_ind, J_ind, :] = interpolate_barrier_positions_JK(molecule, J, K, K_sym)
 
     for ind, pathway in enumerate(pathways):
         save_dir = path.join('script_data', 'barriers', molecule, f'sym_{sym}{sym_suffix}', pathway)
@@ -1,10 +1,72 @@
 #!/usr/bin/env python
+import argparse
+import json
 import numpy as np
 import os
 import os.path as path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Finds number of states below target energy for each J and K and saves them into num_states.txt')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only re-read states files that changed since the last run (according to the saved manifest)')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='Number of states files read in parallel')
+
+    args = parser.parse_args()
+    return args
+
+
+def count_states(states_path: str, target_energy: float) -> int:
+    """ Returns 1-based index of the first state with energy above *target_energy*, or 0 if there is no such state.
+    Reads the file line by line and stops as soon as the target state is found. """
+    with open(states_path) as states_file:
+        states_file.readline()  # skip header
+        state_ind = 0
+        for line in states_file:
+            tokens = line.split()
+            if len(tokens) == 0:
+                continue
+            state_ind += 1
+            if float(tokens[0]) > target_energy:
+                return state_ind
+    return 0
+
+
+def read_num_states(states_path: str, target_energy: float, cached_entry: Dict = None) -> Dict:
+    """ Returns manifest entry (mtime, size, count) for the given states file, or None if the file does not exist or is empty.
+    Reuses *cached_entry* if the file has not changed since it was made. """
+    if not path.exists(states_path):
+        return None
+    states_stat = os.stat(states_path)
+    if states_stat.st_size == 0:
+        return None
+    if cached_entry is not None and cached_entry['mtime'] == states_stat.st_mtime_ns and cached_entry['size'] == states_stat.st_size:
+        return cached_entry
+    return {'mtime': states_stat.st_mtime_ns, 'size': states_stat.st_size, 'count': count_states(states_path, target_energy)}
+
+
+def load_manifest(manifest_path: str, root_path: str, target_energy: float) -> Dict[str, Dict]:
+    """ Loads manifest entries saved by the previous run. Returns empty manifest if it was made for a different tree or target energy. """
+    if not path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest['root_path'] != root_path or manifest['target_energy'] != target_energy:
+        return {}
+    return manifest['entries']
+
+
+def save_manifest(manifest_path: str, root_path: str, target_energy: float, entries: Dict[str, Dict]):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump({'root_path': root_path, 'target_energy': target_energy, 'entries': entries}, manifest_file)
+    os.replace(tmp_path, manifest_path)
 
 
 def main():
+    args = parse_command_line_args()
     #  root_path = '/global/cfs/cdirs/m409/gaidai/ozone/dev/676/half_integers'
     root_path = '/global/cfs/cdirs/m409/gaidai/ozone/dev/686/emax_600/rmax_20/rstep_0.65/half_integers'
     molecule = '686'
@@ -14,29 +76,37 @@ def main():
     sym_suffix = 'H'
     target_energy = 1000
 
-    num_states = np.zeros((len(Ks), len(Js)))
+    save_dir = path.join('script_data', 'num_states', molecule, f'sym_{sym}{sym_suffix}')
+    manifest_path = path.join(save_dir, 'num_states_manifest.json')
+    manifest = load_manifest(manifest_path, root_path, target_energy) if args.incremental else {}
+
+    tasks = []
     for J_ind, J in enumerate(Js):
         for K_ind, K in enumerate(Ks):
             if J > 32 and K % 2 == 1:
                 continue
             if K <= J:
                 states_path = path.join(root_path, f'J_{J}', f'K_{K}', f'symmetry_{sym}', 'eigensolve', 'states.fwc')
-                if path.exists(states_path) and os.stat(states_path).st_size != 0:
-                    state_energies = np.loadtxt(states_path, skiprows=1, usecols=[0])
-                    target_inds = np.where(state_energies > target_energy)[0]
-                    if len(target_inds) == 0:
-                        print(f'Insufficient number of states in {J}, {K}')
-                        target_ind = -1
-                    else:
-                        target_ind = target_inds[0]
-                    num_states[K_ind, J_ind] = target_ind + 1
-                else:
-                    print(f'{J}, {K} not found')
-                    num_states[K_ind, J_ind] = 0
+                tasks.append((J_ind, K_ind, f'{J},{K},{sym}', states_path))
+
+    with ThreadPoolExecutor(args.workers) as executor:
+        entries = list(executor.map(lambda task: read_num_states(task[3], target_energy, manifest.get(task[2])), tasks))
+
+    num_states = np.zeros((len(Ks), len(Js)))
+    new_manifest = {}
+    for (J_ind, K_ind, key, states_path), entry in zip(tasks, entries):
+        J, K = Js[J_ind], Ks[K_ind]
+        if entry is None:
+            print(f'{J}, {K} not found')
+            continue
+        if entry['count'] == 0:
+            print(f'Insufficient number of states in {J}, {K}')
+        num_states[K_ind, J_ind] = entry['count']
+        new_manifest[key] = entry
 
-    save_dir = path.join('script_data', 'num_states', molecule, f'sym_{sym}{sym_suffix}')
     os.makedirs(save_dir, exist_ok=True)
     np.savetxt(path.join(save_dir, 'num_states.txt'), num_states)
+    save_manifest(manifest_path, root_path, target_energy, new_manifest)
 
 
 if __name__ == '__main__':
@@ -1,24 +1,31 @@
 #!/usr/bin/env python3
+import io
 import numpy as np
 import pathlib
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from common import *
+from lookup_server import interpolate_table
 
 import sys
 sys.path.append("/global/u2/g/gaidai/SpectrumSDT_ifort/scripts/")
 from SpectrumSDTConfig import SpectrumSDTConfig
 
+known_Js = list(range(0, 33, 2)) + list(range(36, 65, 4))
+known_Ks = list(range(0, 21, 2))
 
-def get_vdw_barriers(molecule: str, sym: str, Js: List[int], Ks: List[int], J: int, K: int) -> Dict[str, float]:
-    """ Loads VdW barriers correspond to the given arguments. """
-    base_load_path = pathlib.Path(__file__).resolve().parent / "script_data" / "barriers" / molecule / f"sym_{sym}"
+
+def get_vdw_barriers(molecule: str, sym: str, Js: List[int], Ks: List[int], J: int, K: int, barriers_path: pathlib.Path = None) -> Dict[str, float]:
+    """ Loads VdW barriers correspond to the given arguments. Uses lookup server if it is running.
+    Barrier tables are taken from script_data, unless a different *barriers_path* is given. """
+    if barriers_path is None:
+        barriers_path = pathlib.Path(__file__).resolve().parent / "script_data" / "barriers"
+    base_load_path = pathlib.Path(barriers_path) / molecule / f"sym_{sym}"
     pathways = ["all"] if is_monoisotopomer(molecule) else ["B", "A", "S"]
     vdw_barriers = {}
     for pathway in pathways:
         load_path = base_load_path / pathway / "barriers.txt"
-        barriers_JK = np.loadtxt(load_path)
-        vdw_barriers[pathway] = interpolate_JK(Js, Ks, barriers_JK, J, K)
+        vdw_barriers[pathway] = interpolate_table(Js, Ks, str(load_path), J, K)
     return vdw_barriers
 
 
@@ -45,11 +52,20 @@ def get_phi_barriers(molecule: str) -> Dict[str, List[float]]:
     return phi_barriers
 
 
-def write_wf_sections(file_name: str, molecule: str, vdw_barriers: Dict[str, float], phi_barriers: Dict[str, List[float]], Ks: List[int]):
-    """ Appends wave function section descriptions corresponding to given arguments to given *file_name*.
+def get_barriers_reference(config: SpectrumSDTConfig) -> Tuple[str, str]:
+    """ Returns molecule and symmetry name of the reference barriers used for the given config. """
+    mass = config.get_mass_str()
+    molecule = get_ozone_molecule(mass)
+    #  symmetry = config.get_full_symmetry_name()
+    symmetry = '1'
+    return molecule, symmetry
+
+
+def format_wf_sections(molecule: str, vdw_barriers: Dict[str, float], phi_barriers: Dict[str, List[float]], Ks: List[int]) -> str:
+    """ Returns wave function section descriptions corresponding to given arguments.
         Barrier positions are given in order: B, A, S. """
     monoisotopomer = is_monoisotopomer(molecule)
-    with open(file_name, "a") as file:
+    with io.StringIO() as file:
         file.write("\n")
         file.write("wf_sections = (\n")
         for pathway, vdw_barrier in vdw_barriers.items():
@@ -101,18 +117,19 @@ def write_wf_sections(file_name: str, molecule: str, vdw_barriers: Dict[str, flo
                 file.write("  )\n")
 
         file.write(")\n")
+        return file.getvalue()
+
+
+def write_wf_sections(file_name: str, molecule: str, vdw_barriers: Dict[str, float], phi_barriers: Dict[str, List[float]], Ks: List[int]):
+    """ Appends wave function section descriptions corresponding to given arguments to given *file_name*. """
+    with open(file_name, "a") as file:
+        file.write(format_wf_sections(molecule, vdw_barriers, phi_barriers, Ks))
 
 
 def main():
     """ Reads SpectrumSDT config, determines ozone wf integration boundaries for the specified parameters and adds them to the config. """
-    known_Js = list(range(0, 33, 2)) + list(range(36, 65, 4))
-    known_Ks = list(range(0, 21, 2))
-
     config = SpectrumSDTConfig("spectrumsdt.config")
-    mass = config.get_mass_str()
-    molecule = get_ozone_molecule(mass)
-    #  symmetry = config.get_full_symmetry_name()
-    symmetry = '1'
+    molecule, symmetry = get_barriers_reference(config)
     J = config.get_J()
     Ks = config.get_Ks()
 
@@ -122,4 +139,5 @@ def main():
     write_wf_sections("spectrumsdt.config", molecule, vdw_barriers, phi_barriers, Ks)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import os
+import os.path as path
+import re
+from typing import Dict, List
+
+# Default output of GNU time (one record per srun task, since time is called under srun)
+time_record_regex = re.compile(r"([\d.]+)user\s+([\d.]+)system\s+([\d:.]+)elapsed\s+\S+CPU\s+\(\S+avgtext\+\S+avgdata\s+(\d+)maxresident\)k")
+folder_regexes = {name: re.compile(r"(?:^|/){0}_(\d+)(?:/|$)".format(name)) for name in ["J", "K", "symmetry"]}
+fields = ["path", "stage", "J", "K", "sym", "job_id", "nodes", "nprocs", "tasks", "elapsed", "user", "system", "max_rss_kb",
+          "node_hours", "cpu_efficiency", "memory_headroom"]
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Collects and reports performance telemetry of SpectrumSDT jobs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    collect_parser = subparsers.add_parser("collect", help="Walks the campaign tree and collects telemetry of all jobs into a table")
+    collect_parser.add_argument("root_path", nargs="?", default=".", help="Path to campaign tree")
+    collect_parser.add_argument("-o", "--output", default="telemetry.csv", help="Path to output table")
+    collect_parser.add_argument("-tfn", "--time-file-name", default="time.out", help="Name of time output files")
+    collect_parser.add_argument("-on", "--outname", default="out.slurm", help="Name of slurm output files")
+    collect_parser.add_argument("-nm", "--node-memory", type=float, default=128, help="Memory per node (GB)")
+
+    report_parser = subparsers.add_parser("report", help="Summarizes collected telemetry")
+    report_parser.add_argument("table", nargs="?", default="telemetry.csv", help="Path to table made by collect")
+
+    args = parser.parse_args()
+    return args
+
+
+def parse_duration(duration: str) -> float:
+    """ Converts [[h:]m:]s string to seconds. """
+    seconds = 0
+    for part in duration.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_time_file(time_path: str) -> Dict:
+    """ Returns job-wide elapsed time (max over tasks), user and system time (sum over tasks) and max RSS (max over tasks). """
+    with open(time_path) as time_file:
+        records = time_record_regex.findall(time_file.read())
+    if len(records) == 0:
+        return None
+    return {"tasks": len(records),
+            "elapsed": max(parse_duration(record[2]) for record in records),
+            "user": sum(float(record[0]) for record in records),
+            "system": sum(float(record[1]) for record in records),
+            "max_rss_kb": max(int(record[3]) for record in records)}
+
+
+def parse_job_id(slurm_out_path: str) -> str:
+    """ Returns job ID echoed into the slurm output (the first line consisting of a number only). """
+    if not path.exists(slurm_out_path):
+        return ""
+    with open(slurm_out_path, errors="replace") as slurm_out:
+        for line in slurm_out:
+            if line.strip().isdigit():
+                return line.strip()
+    return ""
+
+
+def parse_sbatch(sbatch_path: str) -> Dict:
+    """ Returns number of nodes and processes requested in the sbatch script generated by o3_submit.py. """
+    resources = {"nodes": 0, "nprocs": 0}
+    if not path.exists(sbatch_path):
+        return resources
+    with open(sbatch_path) as sbatch:
+        for line in sbatch:
+            tokens = line.split()
+            if line.startswith("#SBATCH -N "):
+                resources["nodes"] = int(tokens[2])
+            elif line.startswith("srun ") and "-n" in tokens:
+                resources["nprocs"] = int(tokens[tokens.index("-n") + 1])
+    return resources
+
+
+def collect_job(folder: str, args: argparse.Namespace) -> Dict:
+    """ Collects telemetry of the job that ran in *folder*. Returns None if the folder has no time records. """
+    timing = parse_time_file(path.join(folder, args.time_file_name))
+    if timing is None:
+        return None
+    job = {"path": folder, "stage": path.basename(path.abspath(folder)), "job_id": parse_job_id(path.join(folder, args.outname))}
+    for name, key in [("J", "J"), ("K", "K"), ("symmetry", "sym")]:
+        match = folder_regexes[name].search(folder)
+        job[key] = int(match.group(1)) if match is not None else ""
+    job.update(parse_sbatch(path.join(folder, path.splitext(args.outname)[0] + ".sbatch")))
+    job.update(timing)
+
+    nprocs = job["nprocs"] if job["nprocs"] > 0 else job["tasks"]
+    job["node_hours"] = job["nodes"] * job["elapsed"] / 3600
+    job["cpu_efficiency"] = (job["user"] + job["system"]) / (job["elapsed"] * nprocs) if job["elapsed"] > 0 else ""
+    if job["nodes"] > 0:
+        ranks_per_node = nprocs / job["nodes"]
+        job["memory_headroom"] = 1 - job["max_rss_kb"] * ranks_per_node / (args.node_memory * 1024 ** 2)
+    else:
+        job["memory_headroom"] = ""
+    return job
+
+
+def collect(args: argparse.Namespace):
+    jobs = []
+    for folder, _, file_names in os.walk(args.root_path):
+        if args.time_file_name in file_names:
+            job = collect_job(folder, args)
+            if job is not None:
+                jobs.append(job)
+    jobs.sort(key=lambda job: job["path"])
+    with open(args.output, "w", newline="") as output:
+        writer = csv.DictWriter(output, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(jobs)
+    print("Collected {0} jobs into {1}".format(len(jobs), args.output))
+
+
+def print_summary(title: str, jobs: List[Dict], key):
+    """ Prints node-hours, mean CPU efficiency and min memory headroom of *jobs* grouped by *key*. """
+    groups = {}
+    for job in jobs:
+        groups.setdefault(key(job), []).append(job)
+    total_node_hours = sum(float(job["node_hours"]) for job in jobs)
+    print(title)
+    print("{0:<20}{1:>8}{2:>14}{3:>10}{4:>14}{5:>18}".format("group", "jobs", "node-hours", "share", "cpu eff.", "min mem headroom"))
+    for group_key in sorted(groups):
+        group = groups[group_key]
+        node_hours = sum(float(job["node_hours"]) for job in group)
+        efficiencies = [float(job["cpu_efficiency"]) for job in group if job["cpu_efficiency"] != ""]
+        headrooms = [float(job["memory_headroom"]) for job in group if job["memory_headroom"] != ""]
+        print("{0:<20}{1:>8}{2:>14.2f}{3:>10.1%}{4:>14}{5:>18}".format(
+            str(group_key), len(group), node_hours, node_hours / total_node_hours if total_node_hours > 0 else 0,
+            "{0:.1%}".format(sum(efficiencies) / len(efficiencies)) if len(efficiencies) > 0 else "-",
+            "{0:.1%}".format(min(headrooms)) if len(headrooms) > 0 else "-"))
+    print()
+
+
+def report(args: argparse.Namespace):
+    with open(args.table, newline="") as table:
+        jobs = list(csv.DictReader(table))
+    print_summary("By stage", jobs, lambda job: job["stage"])
+    print_summary("By J", jobs, lambda job: int(job["J"]) if job["J"] != "" else -1)
+    print_summary("By K", jobs, lambda job: int(job["K"]) if job["K"] != "" else -1)
+
+
+def main():
+    args = parse_command_line_args()
+    if args.command == "collect":
+        collect(args)
+    elif args.command == "report":
+        report(args)
+
+
+if __name__ == "__main__":
+    main()
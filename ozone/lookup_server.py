@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+import argparse
+import json
+import numbers
+import os
+import socket
+import socketserver
+import threading
+from typing import Dict, List
+
+# Unix sockets are local to a node, so the server has to run on the node where the queries are made
+socket_path = os.environ.get('OZONE_LOOKUP_SOCKET', f'/tmp/ozone_lookup_{os.getuid()}.sock')
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Resident server that keeps reference (J, K) tables (number of states, barriers) '
+                                                 'and their interpolators in memory and answers interpolation queries over a Unix socket')
+    parser.add_argument('-s', '--socket', default=socket_path, help='Path to the socket')
+    args = parser.parse_args()
+    return args
+
+
+class LookupHandler(socketserver.StreamRequestHandler):
+    """ Answers queries, one JSON object per line: {"path": table path, "Js": [...], "Ks": [...], "J": J, "K": K}. """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                query = json.loads(line)
+                interpolator = self.server.get_interpolator(query['Js'], query['Ks'], query['path'])
+                answer = {'value': float(interpolator(query['J'], query['K']))}
+            except Exception as error:
+                answer = {'error': str(error)}
+            self.wfile.write((json.dumps(answer) + '\n').encode())
+
+
+class LookupServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, server_path: str):
+        super().__init__(server_path, LookupHandler)
+        self.interpolators = {}
+        self.lock = threading.Lock()
+
+    def get_interpolator(self, Js: List[int], Ks: List[int], table_path: str):
+        """ Returns interpolator of a table. Interpolators are rebuilt when their table changes. """
+        from common import JKInterpolator
+        table_stat = os.stat(table_path)
+        key = (table_path, tuple(Js), tuple(Ks))
+        with self.lock:
+            cached = self.interpolators.get(key)
+            if cached is None or cached[0] != (table_stat.st_mtime_ns, table_stat.st_size):
+                cached = ((table_stat.st_mtime_ns, table_stat.st_size), JKInterpolator.from_file(Js, Ks, table_path))
+                self.interpolators[key] = cached
+        return cached[1]
+
+
+def query_server(query: Dict, server_path: str = None) -> Dict:
+    """ Sends a query to the lookup server. Returns None if the server is not running. """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(server_path or socket_path)
+            client.sendall((json.dumps(query) + '\n').encode())
+            with client.makefile('r') as answer_file:
+                return json.loads(answer_file.readline())
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+
+
+def interpolate_table(Js: List[int], Ks: List[int], table_path: str, J, K):
+    """ Interpolates the (J, K) table at *table_path* at given J and K. Asks the lookup server if it is running, otherwise
+    interpolates locally (as JKInterpolator.from_file(Js, Ks, table_path)(J, K)). Arrays of J and K are always interpolated locally. """
+    answer = None
+    if isinstance(J, numbers.Number) and isinstance(K, numbers.Number):
+        answer = query_server({'path': os.path.abspath(table_path), 'Js': list(Js), 'Ks': list(Ks), 'J': float(J), 'K': float(K)})
+    if answer is None:
+        from common import JKInterpolator
+        return JKInterpolator.from_file(Js, Ks, table_path)(J, K)
+    if 'error' in answer:
+        raise Exception(f'Lookup server failed: {answer["error"]}')
+    return answer['value']
+
+
+def main():
+    args = parse_command_line_args()
+    if os.path.exists(args.socket):
+        if query_server({}, args.socket) is not None:
+            raise Exception(f'Lookup server is already running at {args.socket}')
+        os.remove(args.socket)  # left by a server that did not exit cleanly
+    with LookupServer(args.socket) as server:
+        print(f'Serving at {args.socket}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
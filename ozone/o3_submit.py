@@ -3,6 +3,7 @@
 from __future__ import annotations
 
 import argparse
+import json
 import math
 import os
 import os.path as path
@@ -16,8 +17,11 @@ from SpectrumSDTConfig import SpectrumSDTConfig
 
 class SubmissionScript:
     def __init__(self, filesystem: str, qos: str, nodes: str, time: str, time_min:str, job_name: str, out_name: str, node_type: str,
-            n_procs: str, cores_per_proc: str, program_location: str, program_out_file_name: str, time_file_name: str, sbcast: bool):
+            n_procs: str, cores_per_proc: str, program_location: str, program_out_file_name: str, time_file_name: str, sbcast: bool,
+            requeue: bool, signal_lead: str, max_requeues: str):
         self.program_name = "spectrumsdt"
+        # Remaining time (in minutes) of a requeued job
+        self.time_left_file_name = ".time_left"
         self.filesystem = filesystem
         self.qos = qos
         self.nodes = nodes
@@ -32,6 +36,9 @@ class SubmissionScript:
         self.program_out_file_name = program_out_file_name
         self.time_file_name = time_file_name
         self.sbcast = sbcast
+        self.requeue = requeue
+        self.signal_lead = signal_lead
+        self.max_requeues = max_requeues
         self.script_name = path.splitext(self.out_name)[0] + ".sbatch"
 
     @classmethod
@@ -43,8 +50,52 @@ class SubmissionScript:
         n_procs = str(args.nprocs)
 
         cores_per_proc = str(int(ParameterMaster.cores_per_node * args.nodes / args.nprocs) * ParameterMaster.threads_per_core)
+        signal_lead = "{:.0f}".format(args.signal_lead * 60)
+        max_requeues = str(args.max_requeues)
+        # A requeued job continues from the checkpoint, so stages that cannot resume would only repeat the same work
+        requeue = args.requeue and path.isfile(args.config) and SpectrumSDTConfig(args.config).get_stage() in ParameterMaster.checkpoint_stages
+        if args.requeue and not requeue:
+            print("Warning: --requeue is ignored, since this stage cannot continue from a checkpoint", file=sys.stderr)
         return cls(args.filesystem, args.qos, nodes, time, time_min, args.jobname, args.outname, ParameterMaster.nodes_type,
-                n_procs, cores_per_proc, args.program_location, args.program_out_file_name, args.time_file_name, args.sbcast)
+                n_procs, cores_per_proc, args.program_location, args.program_out_file_name, args.time_file_name, args.sbcast,
+                requeue, signal_lead, max_requeues)
+
+    def get_requeue_lines(self) -> str:
+        """ Returns a bash function that is called on the early warning signal before preemption or time limit. It lets the program
+        write a checkpoint, then requeues the job with time limit reduced by the time spent so far (at most max_requeues times). """
+        # The tasks of the main step are GNU time processes, so the signal is sent to the program itself by a step on each node
+        signal_line = "    srun -N $SLURM_JOB_NUM_NODES --ntasks-per-node=1 --overlap pkill -USR1 -x " + self.program_name + "\n"
+        # The program gets most of the warning time to write the checkpoint, the rest is left for stopping it and requeueing the job
+        checkpoint_timeout = str(int(self.signal_lead) * 3 // 4)
+        # The requeued job should have time for more than just getting to the next warning signal
+        min_time_left = str(2 * math.ceil(int(self.signal_lead) / 60))
+        return ("requeue_job() {\n"
+                + "    echo Caught preemption signal\n"
+                + signal_line
+                + "    checkpoint_deadline=$(( SECONDS + " + checkpoint_timeout + " ))\n"
+                + "    while kill -0 $srun_pid 2> /dev/null && [ $SECONDS -lt $checkpoint_deadline ]; do sleep 5; done\n"
+                + "    if kill -0 $srun_pid 2> /dev/null; then\n"
+                + "        echo Checkpoint is not written in " + checkpoint_timeout + " seconds, stopping the program\n"
+                + "        kill $srun_pid\n"
+                + "        sleep 10\n"
+                + "        kill -9 $srun_pid 2> /dev/null\n"
+                + "    fi\n"
+                + "    if [ ${SLURM_RESTART_COUNT:-0} -ge " + self.max_requeues + " ]; then\n"
+                + "        echo Requeue limit of " + self.max_requeues + " is reached, resubmit manually to continue from the checkpoint\n"
+                + "        exit 0\n"
+                + "    fi\n"
+                + "    time_left=$(( $(cat " + self.time_left_file_name + ") - SECONDS / 60 ))\n"
+                + "    if [ $time_left -lt " + min_time_left + " ]; then time_left=" + min_time_left + "; fi\n"
+                + "    time_min=$(( time_left < " + self.time_min + " ? time_left : " + self.time_min + " ))\n"
+                + "    echo $time_left > " + self.time_left_file_name + "\n"
+                # Requeue terminates this script, it has to survive until the time limit of the pending job is updated.
+                # The limit cannot be updated before requeue, since a limit below the elapsed time ends the running job at once.
+                + "    trap '' TERM\n"
+                + "    scontrol requeue $SLURM_JOB_ID\n"
+                + "    scontrol update JobId=$SLURM_JOB_ID TimeLimit=$time_left TimeMin=$time_min\n"
+                + "    exit 0\n"
+                + "}\n"
+                + "trap requeue_job USR1\n")
 
 
     def write(self):
@@ -63,6 +114,27 @@ class SubmissionScript:
         node_type_line = "#SBATCH -C " + self.node_type + "\n"
         export_pmi_line = "export PMI_MMAP_SYNC_WAIT_TIME=300\n" if self.sbcast else ""
         sbcast_line = "sbcast --compress=lz4 " + program_path + " " + tmp_program_path + "\n" if self.sbcast else ""
+        srun_line = ("srun -n " + self.n_procs + " -c " + self.cores_per_proc + " --cpu_bind=cores time -ao " + self.time_file_name + " "
+                     + call_location)
+        if self.requeue:
+            requeue_lines = ("#SBATCH --signal=B:USR1@" + self.signal_lead + "\n"
+                             + "#SBATCH --requeue\n"
+                             + "#SBATCH --open-mode=append\n")
+            # Outputs of the previous runs are kept when the job is requeued
+            cleanup_lines = ("if [ ${SLURM_RESTART_COUNT:-0} -eq 0 ]; then\n"
+                             + "    rm -f " + self.time_file_name + " " + self.program_out_file_name + "\n"
+                             + "    echo " + self.time + " > " + self.time_left_file_name + "\n"
+                             + "fi\n"
+                             + self.get_requeue_lines())
+            # srun is run in background, so that the trap can be executed while it is running
+            run_lines = (srun_line + " >> " + self.program_out_file_name + " &\n"
+                         + "srun_pid=$!\n"
+                         + "wait $srun_pid\n"
+                         + "rm -f " + self.time_left_file_name + "\n")
+        else:
+            requeue_lines = ""
+            cleanup_lines = "rm -f " + self.time_file_name + "\n"
+            run_lines = srun_line + " > " + self.program_out_file_name + "\n"
         script = ("#!/bin/bash\n"
                   + filesystem_line
                   + qos_line
@@ -73,15 +145,15 @@ class SubmissionScript:
                   + job_line
                   + out_line
                   + node_type_line
+                  + requeue_lines
                   + "\n"
                   + "date\n"
                   + "echo $SLURM_JOB_ID\n"
-                  + "rm -f " + self.time_file_name + "\n"
+                  + cleanup_lines
                   + export_pmi_line
                   + "export FORT_FMT_RECL=$((10*1024*1024))\n"
                   + sbcast_line
-                  + "srun -n " + self.n_procs + " -c " + self.cores_per_proc + " --cpu_bind=cores time -ao " + self.time_file_name + " " 
-                  + call_location + " > " + self.program_out_file_name + "\n")
+                  + run_lines)
         with open(self.script_name, "w") as output:
             output.write(script)
 
@@ -98,6 +170,15 @@ class ParameterMaster:
     pes_file_name = "pes_out.txt"
     config_filename = "spectrumsdt.config"
     stage_result_name = {"basis": "num_vectors_2d.fwc", "overlaps": "time.out", "eigensolve": "states.fwc", "properties": "state_properties.fwc"}
+    # Stages where spectrumsdt writes a checkpoint on SIGUSR1 and continues from it when restarted
+    checkpoint_stages = {"eigensolve", "properties"}
+    # Per-stage node and process multipliers recommended by scaling sweeps (see scaling_sweep.py)
+    scaling_recommendations = {}
+    # Memory model. Estimates are in bytes and only include the dominant arrays, hence the overhead and the usable fraction of node memory
+    memory_sizing = False
+    memory_usable_fraction = 0.85
+    default_states_per_proc = 8
+    rank_memory_overhead = 512 * 1024 ** 2
 
     @staticmethod
     def set_pesprint_params(config_path: str, args: argparse.Namespace):
@@ -129,7 +210,12 @@ class ParameterMaster:
 
         # set up parameters
         args.nprocs = ParameterMaster.get_grid_points_num(config, 1)
-        args.nodes = ParameterMaster.compute_nodes(args.nprocs)
+        if ParameterMaster.memory_sizing:
+            rank_memory = ParameterMaster.estimate_basis_rank_memory(config)
+            args.nodes = ParameterMaster.compute_nodes_for_memory(args.nprocs, rank_memory)
+            ParameterMaster.report_memory_footprint("basis", args.nodes, args.nprocs, rank_memory)
+        else:
+            args.nodes = ParameterMaster.compute_nodes(args.nprocs)
 
     @staticmethod
     def set_overlap_params(args: argparse.Namespace):
@@ -144,8 +230,88 @@ class ParameterMaster:
     @staticmethod
     def set_properties_params(config: SpectrumSDTConfig, args: argparse.Namespace):
         # set up parameters
-        args.nprocs = config.get_number_of_states() / args.states_per_proc
-        args.nodes = ParameterMaster.compute_nodes(args.nprocs)
+        if ParameterMaster.memory_sizing:
+            num_states = config.get_number_of_states()
+            max_states_per_proc = ParameterMaster.get_max_states_per_proc(config)
+            if args.states_per_proc is not None:
+                states_per_proc = min(args.states_per_proc, max_states_per_proc)
+            else:
+                states_per_proc = ParameterMaster.choose_states_per_proc(config, num_states, max_states_per_proc)
+            args.nprocs = math.ceil(num_states / states_per_proc)
+            rank_memory = ParameterMaster.estimate_properties_rank_memory(config, states_per_proc)
+            args.nodes = ParameterMaster.compute_nodes_for_memory(args.nprocs, rank_memory)
+            ParameterMaster.report_memory_footprint("properties", args.nodes, args.nprocs, rank_memory)
+        else:
+            args.nprocs = config.get_number_of_states() / (args.states_per_proc or ParameterMaster.default_states_per_proc)
+            args.nodes = ParameterMaster.compute_nodes(args.nprocs)
+
+    @staticmethod
+    def get_grid_sizes(config: SpectrumSDTConfig) -> List[int]:
+        """ returns number of points along rho, theta and phi """
+        return [ParameterMaster.get_grid_points_num(config, grid_num) for grid_num in range(1, 4)]
+
+    @staticmethod
+    def get_num_Ks(config: SpectrumSDTConfig) -> int:
+        Ks = config.get_Ks()
+        return Ks[1] - Ks[0] + 1
+
+    @staticmethod
+    def get_usable_node_memory() -> float:
+        return ParameterMaster.memory_per_node * 1024 ** 3 * ParameterMaster.memory_usable_fraction
+
+    @staticmethod
+    def estimate_basis_rank_memory(config: SpectrumSDTConfig) -> float:
+        """ Estimates memory of one basis rank. Each rank solves dense 2D (theta x phi) problems of its rho point one K at a time,
+        keeping the Hamiltonian, eigenvectors and solver workspace (3 real matrices), and stores the selected 2D vectors of all Ks
+        (assumed to be at most half of the 2D basis). """
+        _, n_theta, n_phi = ParameterMaster.get_grid_sizes(config)
+        n_2d = n_theta * n_phi
+        return ParameterMaster.rank_memory_overhead + 3 * 8 * n_2d ** 2 + 8 * n_2d ** 2 * ParameterMaster.get_num_Ks(config) / 2
+
+    @staticmethod
+    def get_properties_state_memory(config: SpectrumSDTConfig) -> float:
+        """ Memory of one complex 3D wave function (all Ks) """
+        n_rho, n_theta, n_phi = ParameterMaster.get_grid_sizes(config)
+        return 16 * n_rho * n_theta * n_phi * ParameterMaster.get_num_Ks(config)
+
+    @staticmethod
+    def estimate_properties_rank_memory(config: SpectrumSDTConfig, states_per_proc: int) -> float:
+        """ Estimates memory of one properties rank: wave functions of its states and one real 3D grid buffer """
+        n_rho, n_theta, n_phi = ParameterMaster.get_grid_sizes(config)
+        return (ParameterMaster.rank_memory_overhead + 8 * n_rho * n_theta * n_phi
+                + states_per_proc * ParameterMaster.get_properties_state_memory(config))
+
+    @staticmethod
+    def get_max_states_per_proc(config: SpectrumSDTConfig) -> int:
+        """ returns the largest number of states a properties rank can hold if it has a whole node """
+        base_memory = ParameterMaster.estimate_properties_rank_memory(config, 0)
+        max_states = int((ParameterMaster.get_usable_node_memory() - base_memory) // ParameterMaster.get_properties_state_memory(config))
+        if max_states < 1:
+            raise Exception("A single state does not fit in node memory")
+        return max_states
+
+    @staticmethod
+    def choose_states_per_proc(config: SpectrumSDTConfig, num_states: int, max_states_per_proc: int) -> int:
+        """ returns the number of states per rank that needs the fewest nodes (the smallest such number, for the most ranks) """
+        def get_nodes(states_per_proc: int) -> int:
+            rank_memory = ParameterMaster.estimate_properties_rank_memory(config, states_per_proc)
+            return ParameterMaster.compute_nodes_for_memory(math.ceil(num_states / states_per_proc), rank_memory)
+        return min(range(1, min(max_states_per_proc, num_states) + 1), key=lambda states_per_proc: (get_nodes(states_per_proc), states_per_proc))
+
+    @staticmethod
+    def compute_nodes_for_memory(nprocs: int, rank_memory: float) -> int:
+        """ returns the fewest nodes that fit *nprocs* ranks of *rank_memory* bytes each """
+        ranks_per_node = min(ParameterMaster.compute_cores(1), int(ParameterMaster.get_usable_node_memory() // rank_memory))
+        if ranks_per_node < 1:
+            raise Exception("A single rank ({0:.1f} GB) does not fit in node memory ({1:g} GB)".format(rank_memory / 1024 ** 3, ParameterMaster.memory_per_node))
+        return int(math.ceil(nprocs / ranks_per_node))
+
+    @staticmethod
+    def report_memory_footprint(stage: str, nodes: int, nprocs: int, rank_memory: float):
+        """ Prints predicted footprint to stderr (stdout of verbose mode is parsed by chain_call_next_stage.py) """
+        ranks_per_node = int(math.ceil(nprocs / nodes))
+        print("Predicted {0} footprint: {1:.2f} GB per rank, {2} ranks on {3} nodes, {4:.1f} out of {5:g} GB per node".format(
+            stage, rank_memory / 1024 ** 3, nprocs, nodes, ranks_per_node * rank_memory / 1024 ** 3, ParameterMaster.memory_per_node), file=sys.stderr)
 
     @staticmethod
     def set_spectrumsdt_params(config_path: str, args: argparse.Namespace):
@@ -167,6 +333,20 @@ class ParameterMaster:
         elif stage == "properties":
             ParameterMaster.set_properties_params(config, args)
 
+    @staticmethod
+    def load_scaling_recommendations(recommendations_path: str):
+        with open(recommendations_path) as recommendations_file:
+            ParameterMaster.scaling_recommendations = json.load(recommendations_file)
+
+    @staticmethod
+    def apply_scaling_recommendation(config_path: str, args: argparse.Namespace):
+        """ Sets node and process multipliers recommended for the config's stage, if there is a recommendation. """
+        stage = SpectrumSDTConfig(config_path).get_stage()
+        recommendation = ParameterMaster.scaling_recommendations.get(stage)
+        if recommendation is not None:
+            args.nodes_mult = recommendation["nodes_mult"]
+            args.procs_mult = recommendation["procs_mult"]
+
     @staticmethod
     def compute_nodes(cores: int, hyperthreading: bool = None) -> int:
         """ returns required number of nodes for specified number of cores """
@@ -212,9 +392,22 @@ def parse_command_line_args() -> argparse.Namespace:
     parser.add_argument("-fs", "--filesystem", default="none", help="Controls filesystem requirements")
     parser.add_argument("-c", "--node-type", default="haswell", choices=["haswell", "amd"], help="Node type")
     parser.add_argument("-r", "--resubmit", type=int, default=1, help="If 0, does not submit job if job result exists.")
+    parser.add_argument("-sr", "--scaling-recommendations",
+                        help="Path to scaling recommendations made by scaling_sweep.py. Used instead of the default multipliers for implicitly computed resources")
+    parser.add_argument("-ms", "--memory-sizing", action="store_true",
+                        help="Size basis and properties jobs by predicted memory footprint: fewest nodes that fit all ranks in node memory. "
+                             "For properties, the number of states per processor is also chosen by the model unless given explicitly")
+    parser.add_argument("-rq", "--requeue", action="store_true",
+                        help="Requeue the job when it is about to be preempted or run out of time (useful with flex and overrun QOS). "
+                             "Only for stages that continue from a checkpoint (eigensolve and properties)")
+    parser.add_argument("-mrq", "--max-requeues", type=int, default=5, help="Maximum number of times the job is requeued (with --requeue)")
+    parser.add_argument("-sl", "--signal-lead", type=float, default=10, help="How early (in minutes) the job is warned before termination (with --requeue)")
+    parser.add_argument("-mpn", "--memory-per-node", type=float, help="Explicit memory per node (GB), used by --memory-sizing")
 
     # Stage-specific options
-    parser.add_argument("-spp", "--states-per-proc", type=int, default=8, help="Number of states per processor for properties calculation")
+    parser.add_argument("-spp", "--states-per-proc", type=int,
+                        help="Number of states per processor for properties calculation. Default: 8, or chosen by memory model with --memory-sizing "
+                             "(an explicit value is the upper limit for the model)")
 
     args = parser.parse_args()
     return args
@@ -225,6 +418,7 @@ def assume_haswell_configuration():
     ParameterMaster.max_shared_cores = 16
     ParameterMaster.max_debug_nodes = 64
     ParameterMaster.threads_per_core = 2
+    ParameterMaster.memory_per_node = 128
     ParameterMaster.nodes_type = "haswell"
 
 
@@ -233,6 +427,7 @@ def assume_amd_configuration():
     ParameterMaster.max_shared_cores = 16
     ParameterMaster.max_debug_nodes = 64
     ParameterMaster.threads_per_core = 2
+    ParameterMaster.memory_per_node = 2048
     ParameterMaster.nodes_type = "amd"
 
 
@@ -241,6 +436,8 @@ def configure_parameter_master(args: argparse.Namespace):
     #  ParameterMaster.nodes_mult = args.nodes_mult
     if args.host_name is not None:
         ParameterMaster.host_name = args.host_name
+    if args.scaling_recommendations is not None:
+        ParameterMaster.load_scaling_recommendations(args.scaling_recommendations)
 
     if args.node_type == "haswell":
         assume_haswell_configuration()
@@ -249,6 +446,10 @@ def configure_parameter_master(args: argparse.Namespace):
     else:
         raise Exception("invalid node type")
 
+    ParameterMaster.memory_sizing = args.memory_sizing
+    if args.memory_per_node is not None:
+        ParameterMaster.memory_per_node = args.memory_per_node
+
 
 def resolve_defaults_config(args: argparse.Namespace):
     # Coditionally determines values for some of the None values in args based on SpectrumSDT config in the working directory
@@ -260,6 +461,8 @@ def resolve_defaults_config(args: argparse.Namespace):
         args.nprocs = ParameterMaster.compute_cores(args.nodes)
     if args.nprocs is None and args.nodes is None:
         ParameterMaster.set_spectrumsdt_params(args.config, args)
+        if args.procs_mult is None and args.nodes_mult is None:
+            ParameterMaster.apply_scaling_recommendation(args.config, args)
 
     if args.jobname is None:
         args.jobname = ParameterMaster.generate_job_name(path.dirname(args.config))
@@ -329,7 +532,7 @@ def main():
         script.submit()
 
     if args.verbose:
-        print("Program folder is " + args_base.program_location)
+        print("Program folder is " + args.program_location)
         print("Host name is " + ParameterMaster.host_name)
         print("Script name is " + script.script_name)
 
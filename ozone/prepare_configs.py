@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import os
+import os.path as path
+from typing import Dict, List, Tuple
+
+from common import *
+from execute_all import eval_list
+import assign_num_states
+import generate_wf_sections
+from SpectrumSDTConfig import SpectrumSDTConfig
+
+
+class ConfigFolder:
+    """ Stores information about a single SpectrumSDT config required to prepare it """
+    def __init__(self, config_path: str):
+        self.config_path = config_path
+        config = SpectrumSDTConfig(config_path)
+        self.J = config.get_J()
+        self.Ks = config.get_Ks()
+        self.states_reference = assign_num_states.get_states_reference(config)
+        self.barriers_reference = generate_wf_sections.get_barriers_reference(config)
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Sets number of states and wf sections in all specified SpectrumSDT configs at once")
+    parser.add_argument("--J", default="[None]", help="Prepares specified values of J")
+    parser.add_argument("--K", default="[None]", help="Prepares specified values of K")
+    parser.add_argument("--sym", default="[0, 1]", help="Prepares specified values of symmetry")
+    parser.add_argument("--stage", default="properties", choices=["basis", "overlaps", "eigensolve", "properties"], help="Prepares specified stage")
+    parser.add_argument("--no-states", dest="states", action="store_false", help="Do not set num_states placeholder")
+    parser.add_argument("--no-wf-sections", dest="wf_sections", action="store_false", help="Do not set wf sections")
+
+    args = parser.parse_args()
+    args.J = eval_list(args.J)
+    args.K = eval_list(args.K)
+    args.sym = eval_list(args.sym)
+    return args
+
+
+def find_config_paths(Js: List[int], Ks: List[int], syms: List[int], stage: str) -> List[str]:
+    """ Returns paths to configs of all specified folders. Follows the same folder structure as execute_all.py. """
+    config_paths = []
+    for j in Js:
+        for k in Ks:
+            if k is not None and k > j:
+                continue
+            for sym in syms:
+                parts = [f"J_{j}"] if j is not None else []
+                parts += [f"K_{k}"] if k is not None else []
+                parts += [f"symmetry_{sym}", stage, "spectrumsdt.config"]
+                config_paths.append(path.join(*parts))
+    return config_paths
+
+
+def group_folders(folders: List[ConfigFolder], reference_name: str) -> Dict[Tuple[str, str], List[int]]:
+    """ Groups indices of *folders* by the value of the specified reference attribute. """
+    groups = {}
+    for ind, folder in enumerate(folders):
+        groups.setdefault(getattr(folder, reference_name), []).append(ind)
+    return groups
+
+
+def estimate_all_states(folders: List[ConfigFolder]) -> List[int]:
+    """ Estimates number of states for all folders, evaluating each reference table once on all relevant (J, K). """
+    all_states = [0] * len(folders)
+    for (molecule, sym_name), inds in group_folders(folders, "states_reference").items():
+        interpolator = assign_num_states.get_states_interpolator(molecule, sym_name)
+        Js = np.array([folders[ind].J for ind in inds])
+        Ks = np.array([folders[ind].Ks[0] for ind in inds])  # Assuming sym top rotor
+        states = np.ceil(interpolator(Js, Ks) * assign_num_states.states_multiplier(Ks))
+        for ind, folder_states in zip(inds, states):
+            if np.isnan(folder_states):
+                raise Exception(f"Number of states cannot be interpolated for {folders[ind].config_path}")
+            all_states[ind] = int(folder_states)
+    return all_states
+
+
+def format_all_wf_sections(folders: List[ConfigFolder]) -> List[str]:
+    """ Generates wf sections for all folders, evaluating each reference barrier table once on all relevant (J, K). """
+    all_sections = [""] * len(folders)
+    for (molecule, symmetry), inds in group_folders(folders, "barriers_reference").items():
+        Js = np.array([folders[ind].J for ind in inds])
+        Ks = np.array([folders[ind].Ks[0] for ind in inds])  # Taking barriers of first K (does not matter for symmetric top rotor)
+        vdw_barriers = generate_wf_sections.get_vdw_barriers(molecule, symmetry, generate_wf_sections.known_Js, generate_wf_sections.known_Ks, Js, Ks)
+        phi_barriers = generate_wf_sections.get_phi_barriers(molecule)
+        for pos, ind in enumerate(inds):
+            folder_barriers = {pathway: barriers[pos] for pathway, barriers in vdw_barriers.items()}
+            all_sections[ind] = generate_wf_sections.format_wf_sections(molecule, folder_barriers, phi_barriers, folders[ind].Ks)
+    return all_sections
+
+
+def set_states(content: str, states: int) -> str:
+    """ Replaces num_states placeholder in config *content*. Does nothing if the placeholder has already been replaced. """
+    return content.replace("{num_states}", str(states))
+
+
+def set_wf_sections(content: str, sections: str) -> str:
+    """ Replaces wf sections in config *content* with *sections*, or appends them if the config does not have any yet. """
+    start = content.find(sections[:sections.index("(") + 2])
+    if start >= 0:
+        end = content.index("\n)\n", start) + len("\n)\n")
+        content = content[:start] + content[end:]
+    return content + sections
+
+
+def write_config(config_path: str, content: str):
+    """ Atomically replaces config file content. Does not touch the file if the content is unchanged. """
+    with open(config_path) as config_file:
+        if config_file.read() == content:
+            return
+    tmp_path = config_path + ".tmp"
+    with open(tmp_path, "w") as tmp_file:
+        tmp_file.write(content)
+    os.replace(tmp_path, config_path)
+
+
+def main():
+    """ Prepares all configs of a campaign in a single process. Equivalent to running assign_num_states.py and generate_wf_sections.py
+    in each folder, but can be rerun safely. """
+    args = parse_command_line_args()
+    config_paths = [config_path for config_path in find_config_paths(args.J, args.K, args.sym, args.stage) if path.isfile(config_path)]
+    folders = [ConfigFolder(config_path) for config_path in config_paths]
+    all_states = estimate_all_states(folders) if args.states else None
+    all_sections = format_all_wf_sections(folders) if args.wf_sections else None
+
+    for ind, folder in enumerate(folders):
+        with open(folder.config_path) as config_file:
+            content = config_file.read()
+        if all_states is not None:
+            content = set_states(content, all_states[ind])
+        if all_sections is not None:
+            content = set_wf_sections(content, all_sections[ind])
+        write_config(folder.config_path, content)
+    print(f"Prepared {len(folders)} configs")
+
+
+if __name__ == "__main__":
+    main()
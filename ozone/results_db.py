@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+import argparse
+import numpy as np
+import os
+import os.path as path
+import pathlib
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+states_file_name = 'state_properties.fwc'
+folder_regex = re.compile(r'J_(\d+)/K_(\d+)/symmetry_(\d+)')
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Collects state properties of all J, K and symmetries into a single database')
+    parser.add_argument('root_path', help='Path to the folder with J_* folders (either calculation or results tree)')
+    parser.add_argument('-db', '--database', default='results.sqlite', help='Path to the database file')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='Number of files read in parallel')
+
+    args = parser.parse_args()
+    return args
+
+
+def find_states_files(root_path: str) -> List[Tuple[int, int, int, str]]:
+    """ Finds all state properties files in *root_path* and returns (J, K, sym, path) for each. Supports both the calculation tree
+    (with stage folder) and the results tree made by copy_states.py. """
+    files = []
+    root = pathlib.Path(root_path)
+    for pattern in [f'J_*/K_*/symmetry_*/properties/{states_file_name}', f'J_*/K_*/symmetry_*/{states_file_name}']:
+        for file_path in root.glob(pattern):
+            J, K, sym = map(int, folder_regex.search(file_path.relative_to(root).as_posix()).groups())
+            files.append((J, K, sym, str(file_path)))
+    return sorted(files)
+
+
+def read_states_file(file_path: str) -> Tuple[List[str], np.ndarray]:
+    """ Reads column names (header) and values of a state properties file. """
+    with open(file_path) as states_file:
+        header = states_file.readline().split()
+    values = np.loadtxt(file_path, skiprows=1, ndmin=2)
+    if len(header) != values.shape[1]:
+        header = [f'col_{ind}' for ind in range(values.shape[1])]
+    return header, values
+
+
+def quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class ResultsDatabase:
+    """ SQLite database of state properties with a (J, K, sym, state) index. Each source file is recorded with its mtime and size,
+    so repeated ingestion only reads new or changed files. """
+    def __init__(self, db_path: str):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (J INTEGER, K INTEGER, sym INTEGER, path TEXT, mtime INTEGER, size INTEGER, '
+                                'PRIMARY KEY (J, K, sym))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS states (J INTEGER, K INTEGER, sym INTEGER, state INTEGER, PRIMARY KEY (J, K, sym, state))')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def get_columns(self) -> List[str]:
+        """ Returns names of all columns of the states table. """
+        return [row[1] for row in self.connection.execute('PRAGMA table_info(states)')]
+
+    def add_columns(self, columns: List[str]):
+        existing = self.get_columns()
+        for column in columns:
+            if column not in existing:
+                self.connection.execute(f'ALTER TABLE states ADD COLUMN {quote(column)} REAL')
+
+    def is_ingested(self, J: int, K: int, sym: int, file_path: str) -> bool:
+        """ Returns True if the file has already been ingested and has not changed since. """
+        row = self.connection.execute('SELECT mtime, size FROM files WHERE J = ? AND K = ? AND sym = ?', (J, K, sym)).fetchone()
+        file_stat = os.stat(file_path)
+        return row is not None and row[0] == file_stat.st_mtime_ns and row[1] == file_stat.st_size
+
+    def ingest_file(self, J: int, K: int, sym: int, file_path: str, header: List[str], values: np.ndarray):
+        """ Replaces all states of given J, K and symmetry with the content of a state properties file. """
+        file_stat = os.stat(file_path)
+        self.add_columns(header)
+        self.connection.execute('DELETE FROM states WHERE J = ? AND K = ? AND sym = ?', (J, K, sym))
+        columns = ', '.join(['J', 'K', 'sym', 'state'] + [quote(column) for column in header])
+        placeholders = ', '.join(['?'] * (len(header) + 4))
+        rows = [(J, K, sym, state_ind + 1, *map(float, state)) for state_ind, state in enumerate(values)]
+        self.connection.executemany(f'INSERT INTO states ({columns}) VALUES ({placeholders})', rows)
+        self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                                (J, K, sym, file_path, file_stat.st_mtime_ns, file_stat.st_size))
+
+    def ingest(self, root_path: str, workers: int = 16) -> int:
+        """ Ingests all new or changed state properties files found in *root_path*. Files are read in parallel.
+        Returns the number of ingested files. """
+        files = [entry for entry in find_states_files(root_path) if not self.is_ingested(*entry)]
+        with ThreadPoolExecutor(workers) as executor:
+            contents = executor.map(lambda entry: read_states_file(entry[3]), files)
+            for entry, (header, values) in zip(files, contents):
+                self.ingest_file(*entry, header, values)
+        self.connection.commit()
+        return len(files)
+
+    def query(self, Js: List[int] = None, Ks: List[int] = None, syms: List[int] = None, columns: List[str] = None) -> Dict[str, np.ndarray]:
+        """ Returns state properties for the specified slices of J, K and symmetry (all values if None) as a dict of column arrays.
+        Rows are ordered by J, K, sym and state. """
+        if columns is None:
+            columns = self.get_columns()
+        conditions = []
+        params = []
+        for name, values in [('J', Js), ('K', Ks), ('sym', syms)]:
+            if values is not None:
+                conditions.append(f'{name} IN ({", ".join(["?"] * len(values))})')
+                params += list(values)
+        where = ' WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else ''
+        rows = self.connection.execute(f'SELECT {", ".join(map(quote, columns))} FROM states{where} ORDER BY J, K, sym, state', params).fetchall()
+        table = np.array(rows, dtype=float).reshape(-1, len(columns))
+        return {column: table[:, ind] for ind, column in enumerate(columns)}
+
+
+def main():
+    args = parse_command_line_args()
+    database = ResultsDatabase(args.database)
+    num_ingested = database.ingest(args.root_path, args.workers)
+    database.close()
+    print(f'Ingested {num_ingested} files into {path.abspath(args.database)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+import argparse
+import json
+import numpy as np
+import os
+import os.path as path
+import shutil
+import subprocess
+from typing import Dict, List
+
+from job_telemetry import parse_sbatch, parse_time_file
+
+import sys
+sys.path.append("/global/u2/g/gaidai/SpectrumSDT_ifort/scripts/")
+from SpectrumSDTConfig import SpectrumSDTConfig
+
+# O3_BIN_PATH as in chain_call_next_stage.py, but by default o3_submit.py is taken from the folder of this script
+submission_script_path = path.join(os.environ.get("O3_BIN_PATH", path.dirname(path.abspath(__file__))), "o3_submit.py")
+config_filename = "spectrumsdt.config"
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Runs a strong scaling sweep of the stage in the current folder and recommends resources for it")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser("submit", help="Makes copies of the stage with different resources and submits them")
+    submit_parser.add_argument("-m", "--multipliers", type=float, nargs="+", default=[0.5, 1, 2, 4], help="Resource multipliers to try")
+    submit_parser.add_argument("-mt", "--multiplier-type", default="nodes", choices=["nodes", "procs"],
+                               help="Which multiplier of o3_submit.py is swept (--node-multiplier or --procs-multiplier)")
+    submit_parser.add_argument("-so", "--submit-options", default="", help="Extra options passed to o3_submit.py")
+    submit_parser.add_argument("-go", "--gen-only", action="store_true", help="Generate sbatch scripts without submission")
+
+    collect_parser = subparsers.add_parser("collect", help="Collects timings of the sweep, fits scaling curve and records recommendation")
+    collect_parser.add_argument("-mt", "--multiplier-type", choices=["nodes", "procs"],
+                                help="Which sweep the recommendation is taken from, if both were run. Default: the only swept type")
+    collect_parser.add_argument("-e", "--min-efficiency", type=float, default=0.7, help="Minimal acceptable parallel efficiency")
+    collect_parser.add_argument("-r", "--recommendations", default="scaling_recommendations.json",
+                                help="Path to recommendations file (read by o3_submit.py --scaling-recommendations)")
+
+    args = parser.parse_args()
+    return args
+
+
+def get_stage_name() -> str:
+    return path.basename(os.getcwd())
+
+
+def get_sweep_folder(multiplier_type: str, multiplier: float) -> str:
+    """ Returns path to the folder of one sweep point. Sweep folders are siblings of the stage folder, so relative paths in config stay valid. """
+    return path.join("..", "{0}_scaling_{1}_{2:g}".format(get_stage_name(), multiplier_type, multiplier))
+
+
+def find_sweep_folders() -> List[str]:
+    """ Returns sweep folders of the current stage ordered by multiplier type and value """
+    prefix = get_stage_name() + "_scaling_"
+    entries = [entry for entry in os.listdir("..") if entry.startswith(prefix)]
+    entries.sort(key=lambda entry: (entry[len(prefix):].rsplit("_", 1)[0], float(entry.rsplit("_", 1)[1])))
+    return [path.join("..", entry) for entry in entries]
+
+
+def submit(args: argparse.Namespace):
+    multiplier_option = "--node-multiplier" if args.multiplier_type == "nodes" else "--procs-multiplier"
+    for multiplier in args.multipliers:
+        sweep_folder = get_sweep_folder(args.multiplier_type, multiplier)
+        os.makedirs(sweep_folder, exist_ok=True)
+        shutil.copy2(config_filename, sweep_folder)
+        command = "{0} {1} {2:g} {3}".format(submission_script_path, multiplier_option, multiplier, args.submit_options)
+        if args.gen_only:
+            command += " --gen-only"
+        subprocess.call(command, shell=True, cwd=sweep_folder)
+
+
+def fit_scaling(resources: np.ndarray, times: np.ndarray) -> Dict[str, float]:
+    """ Fits elapsed times to Amdahl's law T(n) = serial + parallel / n, where n is the number of nodes or processes. """
+    design = np.stack((np.ones_like(resources), 1 / resources), axis=1)
+    (serial, parallel), *_ = np.linalg.lstsq(design, times, rcond=None)
+    return {"serial": serial, "parallel": parallel, "serial_fraction": serial / (serial + parallel)}
+
+
+def predict_efficiencies(fit: Dict[str, float], resources: np.ndarray) -> np.ndarray:
+    """ Returns parallel efficiencies given by the fitted scaling curve, relative to the smallest amount of resources """
+    times = fit["serial"] + fit["parallel"] / resources
+    return times[0] * resources[0] / (times * resources)
+
+
+def analyze_sweep(points: List[Dict], min_efficiency: float) -> Dict:
+    """ Prints scaling table of the points of one multiplier type and returns recommendation. Efficiency is measured against the swept resource:
+    nodes for node sweeps and processes for process sweeps (where the number of nodes may not change). """
+    resource_key = "nodes" if points[0]["type"] == "nodes" else "nprocs"
+    points.sort(key=lambda point: point[resource_key])
+    resources = np.array([point[resource_key] for point in points], dtype=float)
+    times = np.array([point["elapsed"] for point in points])
+    speedups = times[0] / times
+    efficiencies = speedups * resources[0] / resources
+    fit = fit_scaling(resources, times)
+    fitted_efficiencies = predict_efficiencies(fit, resources)
+
+    print("Sweep of {0}".format(points[0]["type"]))
+    print("{0:>8}{1:>8}{2:>12}{3:>10}{4:>12}{5:>12}{6:>12}".format("nodes", "procs", "elapsed, s", "speedup", "efficiency", "fitted eff.",
+                                                                  "node-hours"))
+    for point, speedup, efficiency, fitted_efficiency in zip(points, speedups, efficiencies, fitted_efficiencies):
+        print("{0:>8}{1:>8}{2:>12.1f}{3:>10.2f}{4:>12.1%}{5:>12.1%}{6:>12.3f}".format(
+            point["nodes"], point["nprocs"], point["elapsed"], speedup, efficiency, fitted_efficiency, point["nodes"] * point["elapsed"] / 3600))
+    print("Fitted serial fraction: {0:.3f}".format(fit["serial_fraction"]))
+
+    # Largest resources that run efficiently enough according to the fitted curve, which is less sensitive to noise of single runs
+    best_ind = max([ind for ind in range(len(points)) if fitted_efficiencies[ind] >= min_efficiency], default=0)
+    best = points[best_ind]
+    multiplier_key = "nodes_mult" if best["type"] == "nodes" else "procs_mult"
+    other_key = "procs_mult" if best["type"] == "nodes" else "nodes_mult"
+    # Same rules as in o3_submit.resolve_defaults_config for the multiplier that is not given explicitly
+    if best["type"] == "nodes":
+        other_multiplier = 1 if best["multiplier"] > 1 else best["multiplier"]
+    else:
+        other_multiplier = best["multiplier"] if best["multiplier"] > 1 else 1
+    print("Recommended for {0}: {1} nodes, {2} procs ({3} = {4:g})".format(get_stage_name(), best["nodes"], best["nprocs"], multiplier_key,
+                                                                          best["multiplier"]))
+    return {multiplier_key: best["multiplier"], other_key: other_multiplier, "nodes": best["nodes"], "nprocs": best["nprocs"],
+            "efficiency": efficiencies[best_ind], "fitted_efficiency": fitted_efficiencies[best_ind], "serial_fraction": fit["serial_fraction"]}
+
+
+def collect(args: argparse.Namespace):
+    points = []
+    for sweep_folder in find_sweep_folders():
+        timing = parse_time_file(path.join(sweep_folder, "time.out")) if path.exists(path.join(sweep_folder, "time.out")) else None
+        if timing is None:
+            print("{0} has no timings yet".format(sweep_folder))
+            continue
+        resources = parse_sbatch(path.join(sweep_folder, "out.sbatch"))
+        multiplier_type, multiplier = sweep_folder.split("_scaling_")[1].rsplit("_", 1)
+        points.append({"folder": sweep_folder, "type": multiplier_type, "multiplier": float(multiplier), "nodes": resources["nodes"],
+                       "nprocs": resources["nprocs"], "elapsed": timing["elapsed"]})
+    sweeps = {}
+    for point in points:
+        sweeps.setdefault(point["type"], []).append(point)
+    if args.multiplier_type is not None:
+        multiplier_type = args.multiplier_type
+    elif len(sweeps) <= 1:
+        multiplier_type = next(iter(sweeps), "nodes")
+    else:
+        raise Exception("Both node and process sweeps are found, select one with --multiplier-type")
+    if len(sweeps.get(multiplier_type, [])) < 2:
+        raise Exception("At least 2 completed sweep points of {0} are required".format(multiplier_type))
+    recommendation = analyze_sweep(sweeps[multiplier_type], args.min_efficiency)
+
+    recommendations = {}
+    if path.exists(args.recommendations):
+        with open(args.recommendations) as recommendations_file:
+            recommendations = json.load(recommendations_file)
+    recommendations[SpectrumSDTConfig(config_filename).get_stage()] = recommendation
+    with open(args.recommendations, "w") as recommendations_file:
+        json.dump(recommendations, recommendations_file, indent=2)
+
+
+def main():
+    args = parse_command_line_args()
+    if args.command == "submit":
+        submit(args)
+    elif args.command == "collect":
+        collect(args)
+
+
+if __name__ == "__main__":
+    main()
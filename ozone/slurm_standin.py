@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+import argparse
+import heapq
+import json
+import os
+import os.path as path
+import sqlite3
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+# Commands that get stand-in executables
+commands = ["sbatch", "q", "srun", "sub_molpro", "scontrol"]
+config_name = "config.json"
+db_name = "standin.sqlite"
+# Wrappers take start time before python starts, so that interpreter startup is attributed to the stand-in rather than to the caller
+wrapper_template = """#!/bin/bash
+SLURM_STANDIN_START=$(date +%s.%N) exec {python} {script} --dir {dir} {command} "$@"
+"""
+
+
+def parse_command_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Local stand-in for slurm commands (sbatch, q, srun, sub_molpro, scontrol). "
+                                                 "Records calls, simulates queue occupancy and job completion")
+    parser.add_argument("-d", "--dir", default=os.environ.get("SLURM_STANDIN_DIR"), help="Folder with stand-in state")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = subparsers.add_parser("init", help="Creates stand-in state and executables (add <dir>/bin to PATH to use them)")
+    init_parser.add_argument("-l", "--latency", type=float, default=0, help="Delay of each command (seconds)")
+    init_parser.add_argument("-s", "--slots", type=int, default=1000, help="Number of jobs that can run at the same time")
+    init_parser.add_argument("-jd", "--job-duration", type=float, default=60, help="Simulated duration of each job (seconds)")
+    init_parser.add_argument("-e", "--execute", action="store_true",
+                             help="Run submitted sbatch scripts right away (needed to follow chained submissions)")
+
+    subparsers.add_parser("report", help="Summarizes recorded calls")
+    for command in commands:
+        subparsers.add_parser(command, add_help=False)
+
+    # Arguments of emulated commands are not parsed
+    args, args.args = parser.parse_known_args()
+    if args.dir is None:
+        parser.error("stand-in folder is not given (use --dir or SLURM_STANDIN_DIR)")
+    return args
+
+
+def connect(standin_dir: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path.join(standin_dir, db_name), timeout=60)
+    connection.execute("create table if not exists calls (command text, args text, cwd text, start real, duration real)")
+    connection.execute("create table if not exists jobs (id integer primary key, command text, script text, cwd text, submit_time real)")
+    return connection
+
+
+def load_config(standin_dir: str) -> Dict:
+    with open(path.join(standin_dir, config_name)) as config_file:
+        return json.load(config_file)
+
+
+def init(args: argparse.Namespace):
+    standin_dir = path.abspath(args.dir)
+    bin_dir = path.join(standin_dir, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    config = {"latency": args.latency, "slots": args.slots, "job_duration": args.job_duration, "execute": args.execute}
+    with open(path.join(standin_dir, config_name), "w") as config_file:
+        json.dump(config, config_file)
+    if path.exists(path.join(standin_dir, db_name)):
+        os.remove(path.join(standin_dir, db_name))
+    connect(standin_dir).close()
+
+    for command in commands:
+        wrapper_path = path.join(bin_dir, command)
+        with open(wrapper_path, "w") as wrapper:
+            wrapper.write(wrapper_template.format(python=sys.executable, script=path.abspath(__file__), dir=standin_dir, command=command))
+        os.chmod(wrapper_path, 0o755)
+    print(bin_dir)
+
+
+def simulate_queue(submit_times: List[float], slots: int, job_duration: float, now: float) -> int:
+    """ Returns number of jobs that are pending or running at time *now*. Jobs start in order of submission as soon as a slot is free. """
+    slot_free_times = [0.0] * slots
+    in_queue = 0
+    for submit_time in submit_times:
+        start = max(submit_time, heapq.heappop(slot_free_times))
+        heapq.heappush(slot_free_times, start + job_duration)
+        if start + job_duration > now:
+            in_queue += 1
+    return in_queue
+
+
+def add_job(connection: sqlite3.Connection, command: str, script: str) -> int:
+    with connection:
+        cursor = connection.execute("insert into jobs (command, script, cwd, submit_time) values (?, ?, ?, ?)",
+                                    (command, script, os.getcwd(), time.time()))
+    return cursor.lastrowid
+
+
+def run_command(args: argparse.Namespace):
+    """ Emulates one of the slurm commands and records the call """
+    start = float(os.environ.get("SLURM_STANDIN_START", time.time()))
+    config = load_config(args.dir)
+    connection = connect(args.dir)
+    time.sleep(config["latency"])
+    execution_time = 0
+
+    if args.command in ["sbatch", "sub_molpro"]:
+        script = args.args[-1] if len(args.args) > 0 else ""
+        job_id = add_job(connection, args.command, script)
+        print("Submitted batch job {0}".format(job_id))
+        sys.stdout.flush()
+        if args.command == "sbatch" and config["execute"]:
+            execution_start = time.time()
+            with open(path.splitext(script)[0] + ".standin.out", "w") as job_out:
+                subprocess.call(["bash", script], stdout=job_out, stderr=subprocess.STDOUT, env=dict(os.environ, SLURM_JOB_ID=str(job_id)))
+            execution_time = time.time() - execution_start
+    elif args.command == "q":
+        submit_times = [row[0] for row in connection.execute("select submit_time from jobs order by id")]
+        print("JOBID ST NAME")
+        for ind in range(simulate_queue(submit_times, config["slots"], config["job_duration"], time.time())):
+            print("{0} PD standin".format(ind))
+
+    with connection:
+        connection.execute("insert into calls values (?, ?, ?, ?, ?)",
+                           (args.command, " ".join(args.args), os.getcwd(), start, time.time() - start - execution_time))
+    connection.close()
+
+
+def report(args: argparse.Namespace):
+    connection = connect(args.dir)
+    print("{0:<12}{1:>10}{2:>16}{3:>16}".format("command", "calls", "total time, s", "mean time, ms"))
+    for command, count, total in connection.execute("select command, count(*), sum(duration) from calls group by command order by command"):
+        print("{0:<12}{1:>10}{2:>16.2f}{3:>16.1f}".format(command, count, total, total / count * 1000))
+    num_jobs = connection.execute("select count(*) from jobs").fetchone()[0]
+    print("Jobs submitted: {0}".format(num_jobs))
+
+
+def main():
+    args = parse_command_line_args()
+    if args.command == "init":
+        init(args)
+    elif args.command == "report":
+        report(args)
+    else:
+        run_command(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import os.path as path
+
+
+class SpectrumSDTConfig:
+    """ Offline stand-in for SpectrumSDTConfig of the SpectrumSDT install, used by benchmark_submission.py together with slurm_standin.py.
+    Reads "key = value" lines of a config. Stage is taken from the config or, if absent, from the name of the config's folder """
+    def __init__(self, config_path: str):
+        self.config_path = config_path
+        self.params = {}
+        with open(config_path) as config_file:
+            for line in config_file:
+                if "=" in line:
+                    key, value = line.split("!")[0].split("=", 1)
+                    self.params[key.strip()] = value.strip()
+
+    def get_stage(self) -> str:
+        return self.params.get("stage", path.basename(path.dirname(path.abspath(self.config_path))))